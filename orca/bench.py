@@ -0,0 +1,465 @@
+"""Benchmarks against a synthetic batch."""
+
+import logging
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+WORDS = (
+    'the of and to in a is that for it as was with be by on not he this are '
+    'or his from at which but have an they you were her she there been one '
+    'all we their has would when if so no will more out up into do any your '
+    'what some can them other than then only its time these two may first '
+    'orca ocean whale pod salmon tide harbor island kelp survey sighting '
+    'photo album archive letter report minutes council meeting research'
+).split()
+
+
+def misspell(word, rng, edits=1):
+    """Make `edits` random OCR-style errors (drops, extras and swaps) in a word."""
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    for _ in range(edits):
+        i = rng.randrange(len(word))
+        edit = rng.randrange(3)
+        if edit == 0 and len(word) > 1:
+            word = word[:i] + word[i + 1:]
+        elif edit == 1:
+            word = word[:i] + rng.choice(letters) + word[i:]
+        else:
+            word = word[:i] + rng.choice(letters) + word[i + 1:]
+    return word
+
+
+def make_corpus(data_path, count, batch_name='00_bench', album_size=500, seed=0, noise=0.0):
+    """
+    Write a synthetic batch of `count` images to `data_path` and return the
+    batch path. The layout matches what `orca.index.load_img_data` expects:
+    `img/<album>/NNNNNN_date_time_name` plus `json/` and `txt/` folders for
+    each album inside the batch. With `noise`, that fraction of the words in
+    the OCR text are misspelled, which grows the lexicon like real OCR does.
+    """
+    import json
+    import random
+    from datetime import datetime, timedelta
+
+    rng = random.Random(seed)
+    data_path = Path(data_path)
+    batch_path = data_path / batch_name
+    ts = datetime(2023, 1, 1, 8, 0, 0)
+
+    for i in range(count):
+        if i % album_size == 0:
+            album = ts.strftime('%B %Y')
+            img_path = data_path / 'img' / album
+            json_path = batch_path / album / 'json'
+            txt_path = batch_path / album / 'txt'
+            for p in (img_path, json_path, txt_path):
+                p.mkdir(parents=True, exist_ok=True)
+        ts += timedelta(minutes=rng.randint(1, 90))
+
+        stem = f"{(i % album_size) + 1:06}_{ts.strftime('%Y-%m-%d_%H-%M-%S')}_IMG_{i:05}"
+        (img_path / f"{stem}.JPG").write_bytes(b'\xff\xd8\xff\xd9')
+        (json_path / f"{stem}.json").write_text(json.dumps({'name': stem}))
+        words = rng.choices(WORDS, k=rng.randint(50, 300))
+        if noise:
+            words = [
+                misspell(w, rng, rng.randint(1, 2)) if rng.random() < noise else w
+                for w in words
+            ]
+        (txt_path / f"{stem}.txt").write_text(' '.join(words))
+
+    log.info('Wrote %d synthetic images to %s.' % (count, data_path))
+    return batch_path
+
+
+def bench_hit_resolution(count, hits=None):
+    """
+    Time matching `hits` Whoosh results back to image metadata in an index of
+    `count` images, using the old per-hit linear scan and the UUID map that
+    `orca.search.whoosh_query` now builds once per loaded index.
+    """
+    import random
+    from time import perf_counter
+    from uuid import uuid4
+
+    hits = hits or count // 10
+    images = [{'uuid': f"{uuid4()}", 'index': i} for i in range(count)]
+    results = [{'uuid': img['uuid']} for img in random.sample(images, hits)]
+
+    start = perf_counter()
+    for result in results:
+        next(r for r in images if r['uuid'] == result['uuid'])
+    scan = perf_counter() - start
+
+    start = perf_counter()
+    by_uuid = {img['uuid']: img for img in images}
+    for result in results:
+        by_uuid[result['uuid']]
+    lookup = perf_counter() - start
+
+    log.info(
+        'Resolved %d hits in %d documents: scan %.3fs, lookup %.3fs (%.0fx).'
+        % (hits, count, scan, lookup, scan / max(lookup, 1e-9))
+    )
+    return scan, lookup
+
+
+def bench_whoosh_query(batch_path, query_str):
+    """Time a full `orca.search.whoosh_query` run against a built batch."""
+    from time import perf_counter
+    from orca.search import whoosh_query
+
+    start = perf_counter()
+    count = sum(1 for _ in whoosh_query(query_str, batch_path))
+    elapsed = perf_counter() - start
+    log.info('whoosh_query("%s"): %d hits in %.3fs.' % (query_str, count, elapsed))
+    return count, elapsed
+
+
+def bench_spelling(batch_path, samples=200, max_distance=2, seed=0):
+    """
+    Time looking up misspelled words in the spelling index against Whoosh's
+    `FuzzyTerm`, which works out the edit distance to every word in the
+    lexicon, and check that both find the same words. Then time whole fuzzy
+    queries, expanded both ways.
+    """
+    import random
+    from time import perf_counter
+    from whoosh.query import FuzzyTerm
+    from orca.search import load_batch, normalize_filters, whoosh_query
+    from orca.spelling import candidates, spelling_path
+
+    rng = random.Random(seed)
+    batch = load_batch(batch_path)
+    reader = batch['searcher'].reader()
+    spelling_file = spelling_path(batch_path)
+    lexicon = [w.decode('utf-8') for w in reader.lexicon('content')]
+    words = [
+        misspell(w, rng, rng.randint(1, max_distance))
+        for w in rng.sample(lexicon, min(samples, len(lexicon)))
+    ]
+
+    scan = lookup = 0.0
+    mismatches = 0
+    for word in words:
+        start = perf_counter()
+        fuzzy = FuzzyTerm('content', word, maxdist=max_distance, prefixlength=0)
+        expected = set(fuzzy._btexts(reader))
+        scan += perf_counter() - start
+        start = perf_counter()
+        found = {w for w, _, _ in candidates(spelling_file, word, max_distance)}
+        lookup += perf_counter() - start
+        mismatches += found != expected
+    log.info(
+        'Expanded %d misspelled words (distance %d) in a lexicon of %d: '
+        'scan %.3fs, spelling index %.3fs (%.0fx), %d mismatches.'
+        % (
+            len(words),
+            max_distance,
+            len(lexicon),
+            scan,
+            lookup,
+            scan / max(lookup, 1e-9),
+            mismatches,
+        )
+    )
+
+    query_str = ' OR '.join(f"{w}~{max_distance}" for w in words[:10])
+    tolerant = normalize_filters(tolerant=True)
+    timings = {}
+    for mode, filters in (('fuzzy', None), ('tolerant', tolerant)):
+        start = perf_counter()
+        count = sum(1 for _ in whoosh_query(query_str, batch_path, filters, time_limit=0))
+        timings[mode] = perf_counter() - start
+        log.info('whoosh_query(%s): %d hits in %.3fs.' % (mode, count, timings[mode]))
+    return {'scan': scan, 'lookup': lookup, 'mismatches': mismatches, **timings}
+
+
+class FakePhoto:
+    """A stand-in for a pyicloud photo, served from memory."""
+
+    def __init__(self, album, i, created, size):
+        self.album = album
+        self.id = f"fake-{i}"
+        self.filename = f"IMG_{i:05}.JPG"
+        self.created = created
+        self.size = size
+
+    def download(self):
+        """Return the photo's bytes, or fail like a throttled iCloud would."""
+        import time
+        from pyicloud.exceptions import PyiCloudAPIResponseException
+
+        time.sleep(self.album.latency)
+        if self.album.rng.random() < self.album.error_rate:
+            raise PyiCloudAPIResponseException('Service Unavailable', 503)
+        return b'\xff' * self.size
+
+
+class FakeAlbum:
+    """A stand-in for a pyicloud album of `count` photos."""
+
+    def __init__(self, count, size=256 * 1024, latency=0.01, error_rate=0.0, seed=0):
+        import random
+        from datetime import datetime, timedelta
+
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.error_rate = error_rate
+        ts = datetime(2023, 1, 1, 8, 0, 0)
+        self.photos = [
+            FakePhoto(self, i, ts + timedelta(minutes=i), size) for i in range(count)
+        ]
+
+    def __len__(self):
+        return len(self.photos)
+
+    def __iter__(self):
+        return iter(self.photos)
+
+
+def bench_download(dl_path, count, workers=4, error_rate=0.0):
+    """Time `orca.icloud.download_by_album` against a fake album."""
+    from time import perf_counter
+    from types import SimpleNamespace
+    from orca.icloud import download_by_album
+
+    album = FakeAlbum(count, error_rate=error_rate)
+    api = SimpleNamespace(photos=SimpleNamespace(albums={'Fake': album}))
+    start = perf_counter()
+    stats = download_by_album(dl_path, 'Fake', api, retry_delay=0.01, workers=workers)
+    elapsed = perf_counter() - start
+    log.info('download_by_album(%d workers): %.3fs.' % (workers, elapsed))
+    return stats, elapsed
+
+
+def _disk_usage(path):
+    """Return the total size in bytes of the files under `path`."""
+    import os
+
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def _peak_rss_mb():
+    """Return the peak RSS of this process and its children so far, in MB."""
+    import resource
+    import sys
+
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS.
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak / scale
+
+
+def run_pipeline(count, data_path, query_str='orca OR whale', workers=1):
+    """
+    Build a synthetic batch of `count` images in `data_path` and time each
+    stage of the pipeline against it: indexing, the Whoosh index, a raw
+    query, a full search and the txt and docx megadocs.
+
+    Returns a list of dicts, one per stage, with the wall time, the peak RSS
+    so far and the bytes written to `data_path` by that stage. Peak RSS only
+    ever goes up, so run each size in a fresh process (as `run_suite` does).
+    """
+    from time import perf_counter
+    from orca.index import make_index, make_whoosh_index, save_index
+    from orca.megadoc import build_md
+    from orca.search import search, whoosh_query
+
+    records = []
+
+    def timed(stage, fn, *args, **kwargs):
+        disk = _disk_usage(data_path)
+        start = perf_counter()
+        result = fn(*args, **kwargs)
+        elapsed = perf_counter() - start
+        records.append({
+            'stage': stage,
+            'count': count,
+            'seconds': elapsed,
+            'peak_rss_mb': _peak_rss_mb(),
+            'bytes_written': _disk_usage(data_path) - disk,
+        })
+        log.info(
+            '%d docs, %s: %.3fs, peak RSS %.1f MB, %d bytes written.'
+            % (count, stage, elapsed, records[-1]['peak_rss_mb'], records[-1]['bytes_written'])
+        )
+        return result
+
+    def index_batch():
+        index, manifest = make_index(batch_path, workers=workers)
+        save_index(index, manifest)
+        return index
+
+    def build_megadoc(out_file):
+        for _ in build_md(results, out_file):
+            pass
+
+    batch_path = timed('make_corpus', make_corpus, data_path, count)
+    index = timed('make_index', index_batch)
+    timed('make_whoosh_index', make_whoosh_index, index, procs=workers)
+    timed('whoosh_query', lambda: sum(1 for _ in whoosh_query(query_str, batch_path)))
+    results, _ = timed('search', search, query_str, batch_path)
+    doc_path = batch_path / 'cache' / 'megadocs'
+    doc_path.mkdir(parents=True, exist_ok=True)
+    timed('build_md_txt', build_megadoc, doc_path / 'bench.txt')
+    timed('build_md_docx', build_megadoc, doc_path / 'bench.docx')
+    return records
+
+
+def _run_pipeline_in(count, query_str, workers):
+    import tempfile
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        return run_pipeline(count, tmp, query_str, workers)
+
+
+def git_revision():
+    """Return a short description of the checked-out commit, or ''."""
+    import subprocess
+
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run_suite(counts=(1000, 10000, 100000), query_str='orca OR whale', workers=1, results_file=None):
+    """
+    Run the pipeline at each size, each in a fresh process, and append the
+    results (tagged with the current commit) to `results_file` as JSON lines.
+    """
+    import json
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from datetime import datetime
+
+    revision = git_revision()
+    timestamp = datetime.now().isoformat()
+    records = []
+    for count in counts:
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            for record in executor.submit(_run_pipeline_in, count, query_str, workers).result():
+                record.update({'revision': revision, 'timestamp': timestamp})
+                records.append(record)
+
+    if results_file:
+        with open(results_file, 'a') as f:
+            for record in records:
+                f.write(f"{json.dumps(record)}\n")
+        log.info('Saved %d results to %s.' % (len(records), results_file))
+    return records
+
+
+def load_results(results_file, revision=None):
+    """
+    Return the latest result for each (count, stage) in `results_file`, for
+    one revision or across all of them.
+    """
+    import json
+
+    latest = {}
+    with open(results_file) as f:
+        for line in f:
+            record = json.loads(line)
+            if revision is None or record['revision'] == revision:
+                latest[(record['count'], record['stage'])] = record
+    return latest
+
+
+def compare(base, head):
+    """Log each stage of `head` against the same stage of `base`."""
+    for key, record in sorted(head.items()):
+        old = base.get(key)
+        if not old:
+            continue
+        log.info(
+            '%7d %-18s %8.3fs -> %8.3fs (%5.2fx)  %7.1f -> %7.1f MB  %11d -> %11d bytes'
+            % (
+                *key,
+                old['seconds'],
+                record['seconds'],
+                record['seconds'] / max(old['seconds'], 1e-9),
+                old['peak_rss_mb'],
+                record['peak_rss_mb'],
+                old['bytes_written'],
+                record['bytes_written'],
+            )
+        )
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+    )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--counts', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('-q', '--query', default='orca OR whale')
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-o', '--results_file', default='bench_results.jsonl')
+    parser.add_argument('-c', '--compare', metavar='REVISION')
+    parser.add_argument('-s', '--spelling', type=int, metavar='COUNT')
+    parser.add_argument('--hit_resolution', type=int, metavar='COUNT')
+    parser.add_argument('--whoosh_query', type=int, metavar='COUNT')
+    parser.add_argument('--download', type=int, metavar='COUNT')
+    parser.add_argument('--error_rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    # Benchmark one stage on its own, or else run the whole pipeline.
+    if args.hit_resolution:
+        bench_hit_resolution(args.hit_resolution)
+    elif args.whoosh_query:
+        import tempfile
+        from orca.index import make_index, make_whoosh_index, save_index
+
+        with tempfile.TemporaryDirectory() as tmp:
+            batch_path = make_corpus(tmp, args.whoosh_query)
+            index, manifest = make_index(batch_path, workers=args.workers)
+            save_index(index, manifest)
+            make_whoosh_index(index, procs=args.workers)
+            bench_whoosh_query(batch_path, args.query)
+    elif args.download:
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            bench_download(tmp, args.download, args.workers, args.error_rate)
+    elif args.spelling:
+        import tempfile
+        from orca.index import make_index, make_whoosh_index, save_index
+
+        with tempfile.TemporaryDirectory() as tmp:
+            batch_path = make_corpus(tmp, args.spelling, noise=0.1)
+            index, manifest = make_index(batch_path, workers=args.workers)
+            save_index(index, manifest)
+            make_whoosh_index(index, procs=args.workers)
+            bench_spelling(batch_path)
+    else:
+        # Load the baseline before this run's results are added to the file.
+        base = args.compare and load_results(args.results_file, args.compare)
+        records = run_suite(args.counts, args.query, args.workers, args.results_file)
+        if base:
+            compare(base, {(r['count'], r['stage']): r for r in records})
@@ -0,0 +1,336 @@
+"""
+Compact, memory-mapped image index.
+
+index.bin holds the same records as index.json, column by column, so a
+process can open it without parsing anything but a small header and decode
+only the records it touches. The layout is:
+
+- 8 bytes of magic, then the length of the header as a little-endian uint32.
+- The header: UTF-8 JSON with the index's metadata (including its
+  `version`) and album stats, `doc_count`, the album table and the offset
+  and length of each column, padded to 8 bytes.
+- Fixed-width columns, one value per image in index order: `uuid` (16 bytes),
+  `number` (uint32, the image's number in its file name), `timestamp`
+  (int64 seconds), `album` (uint32 into the album table), `position`
+  (uint32, its position in the album) and `flags` (uint8, whether the JSON
+  and TXT files were found).
+- `names`: each image's file name (uint32 offsets into a UTF-8 blob). Every
+  path in a record is rebuilt from its name, its album and the batch.
+- `uuid_table`: an open-addressed hash table of record numbers (plus one,
+  so that 0 is empty) by the first 8 bytes of their UUID, twice as big as
+  there are images, to look images up by UUID.
+"""
+
+import logging
+import struct
+from datetime import datetime
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'ORCAIDX1'
+SCHEMA = 'orca_bin_v1'
+HAS_JSON = 1
+HAS_TXT = 2
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def write_binindex(index, bin_file):
+    """Write an orca_v1 index (as built by `make_index`) to `bin_file`."""
+    import json
+    import sys
+    from array import array
+    from uuid import UUID
+    from orca.index import make_album_stats
+
+    images = index['images']
+    if images and 'album_position' not in images[0]:
+        make_album_stats(images)  # Indexed before album stats existed.
+
+    albums = []
+    album_ids = {}
+    columns = {
+        'uuid': bytearray(),
+        'number': array('I'),
+        'timestamp': array('q'),
+        'album': array('I'),
+        'position': array('I'),
+        'flags': array('B'),
+        'name_offsets': array('I', [0]),
+    }
+    names = bytearray()
+    for img in images:
+        key = (img['album'], img['album_path'])
+        album_id = album_ids.get(key)
+        if album_id is None:
+            album_id = album_ids[key] = len(albums)
+            albums.append(
+                {
+                    'album': img['album'],
+                    'title': img['album_title'],
+                    'path': img['album_path'],
+                    'count': img['album_count'],
+                }
+            )
+        ts = datetime.fromisoformat(img['timestamp'])
+        columns['uuid'] += UUID(img['uuid']).bytes
+        columns['number'].append(img['index'])
+        columns['timestamp'].append(int((ts - EPOCH).total_seconds()))
+        columns['album'].append(album_id)
+        columns['position'].append(img['album_position'])
+        columns['flags'].append(
+            (HAS_JSON if img['json_path'] else 0) | (HAS_TXT if img['txt_path'] else 0)
+        )
+        names += Path(img['path']).name.encode('utf-8')
+        columns['name_offsets'].append(len(names))
+    columns['names'] = names
+
+    uuids = columns['uuid']
+    table_size = 1 << max(1, (2 * len(images)).bit_length())
+    table = array('I', bytes(4 * table_size))
+    for i in range(len(images)):
+        slot = int.from_bytes(uuids[i * 16:i * 16 + 8], 'little') & (table_size - 1)
+        while table[slot]:
+            slot = (slot + 1) & (table_size - 1)
+        table[slot] = i + 1
+    columns['uuid_table'] = table
+
+    blobs = {}
+    for name, column in columns.items():
+        if isinstance(column, array):
+            if sys.byteorder == 'big':
+                column.byteswap()
+            column = column.tobytes()
+        blobs[name] = bytes(column)
+
+    header = {
+        'schema': SCHEMA,
+        'source_schema': index['schema'],
+        'uuid': index['uuid'],
+        'version': index.get('version', index['uuid']),
+        'batch': index['batch'],
+        'batch_path': f"{Path(index['cache_path']).parent}",
+        'cache_path': index['cache_path'],
+        'timestamp': index['timestamp'],
+        'doc_count': len(images),
+        'album_count': len(albums),
+        'album_table': albums,
+        'albums': index.get('albums', {}),
+        'columns': {},
+    }
+
+    # Column offsets depend on the header's length and vice versa, so lay
+    # the columns out after a header that's big enough for any offsets.
+    def pad(n):
+        return -n % 8
+
+    offsets = {name: [0, len(blob)] for name, blob in blobs.items()}
+    while True:
+        header['columns'] = offsets
+        header_bytes = json.dumps(header).encode('utf-8')
+        start = len(MAGIC) + 4 + len(header_bytes)
+        start += pad(start)
+        new_offsets = {}
+        pos = start
+        for name, blob in blobs.items():
+            new_offsets[name] = [pos, len(blob)]
+            pos += len(blob) + pad(len(blob))
+        if new_offsets == offsets:
+            break
+        offsets = new_offsets
+
+    bin_file = Path(bin_file)
+    tmp_file = bin_file.with_name(f".{bin_file.name}.tmp")
+    with tmp_file.open('wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b'\0' * pad(f.tell()))
+        for blob in blobs.values():
+            f.write(blob)
+            f.write(b'\0' * pad(len(blob)))
+    tmp_file.replace(bin_file)
+    return header
+
+
+def current_index_file(cache_path):
+    """
+    Return the image index a batch's cache should be read from: index.bin,
+    unless index.json has been written since, or there's only index.json.
+    """
+    cache_path = Path(cache_path)
+    index_file = cache_path / 'index.json'
+    bin_file = cache_path / 'index.bin'
+    if bin_file.is_file() and (
+        not index_file.is_file()
+        or bin_file.stat().st_mtime_ns >= index_file.stat().st_mtime_ns
+    ):
+        return bin_file
+    return index_file
+
+
+def read_header(bin_file):
+    """Return the header of an index.bin without mapping the rest of it."""
+    import json
+
+    with open(bin_file, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Not an orca binary index: {bin_file}")
+        (size,) = struct.unpack('<I', f.read(4))
+        return json.loads(f.read(size))
+
+
+class BinIndex:
+    """
+    A read-only, memory-mapped index.bin. Records are decoded on access into
+    the same dicts as the images in index.json. Supports len(), indexing,
+    iteration and `get(uuid)`.
+    """
+
+    def __init__(self, bin_file):
+        import json
+        import mmap
+        import os
+
+        self.bin_file = Path(bin_file)
+        with self.bin_file.open('rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not an orca binary index: {bin_file}")
+        (size,) = struct.unpack_from('<I', self._mm, len(MAGIC))
+        start = len(MAGIC) + 4
+        self.header = json.loads(self._mm[start:start + size])
+        self._count = self.header['doc_count']
+        self._columns = {k: v[0] for k, v in self.header['columns'].items()}
+        self._table_size = self.header['columns']['uuid_table'][1] // 4
+
+        # Every path in an album starts the same way, so work that out once.
+        batch_path = Path(self.header['batch_path'])
+        for album in self.header['album_table']:
+            album['prefixes'] = tuple(
+                f"{p}{os.sep}"
+                for p in (
+                    Path(album['path']),
+                    batch_path / album['album'] / 'json',
+                    batch_path / album['album'] / 'txt',
+                )
+            )
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def _u32(self, column, i):
+        return struct.unpack_from('<I', self._mm, self._columns[column] + 4 * i)[0]
+
+    def _uuid(self, i):
+        start = self._columns['uuid'] + 16 * i
+        return self._mm[start:start + 16]
+
+    def __getitem__(self, i):
+        from datetime import timedelta
+        from uuid import UUID
+
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError('Record out of range.')
+
+        mm = self._mm
+        cols = self._columns
+        album = self.header['album_table'][self._u32('album', i)]
+        name_start, name_end = struct.unpack_from('<II', mm, cols['name_offsets'] + 4 * i)
+        start = cols['names']
+        name = mm[start + name_start:start + name_end].decode('utf-8')
+        dot = name.rfind('.')
+        stem = name[:dot] if 0 < dot < len(name) - 1 else name
+        (seconds,) = struct.unpack_from('<q', mm, cols['timestamp'] + 8 * i)
+        ts = EPOCH + timedelta(seconds=seconds)
+        flags = mm[cols['flags'] + i]
+        img_prefix, json_prefix, txt_prefix = album['prefixes']
+
+        return {
+            'uuid': f"{UUID(bytes=self._uuid(i))}",
+            'index': self._u32('number', i),
+            'title': '_'.join(stem.split('_')[3:]),
+            'timestamp': ts.isoformat(),
+            'timestamp_str': ts.strftime('%B %d, %Y at %-I:%M %p'),
+            'path': f"{img_prefix}{name}",
+            'json_path': f"{json_prefix}{stem}.json" if flags & HAS_JSON else '',
+            'txt_path': f"{txt_prefix}{stem}.txt" if flags & HAS_TXT else '',
+            'album': album['album'],
+            'album_title': album['title'],
+            'album_path': album['path'],
+            'album_position': self._u32('position', i),
+            'album_count': album['count'],
+        }
+
+    def find(self, uuid):
+        """Return the record number of an image by UUID, or None."""
+        from uuid import UUID
+
+        try:
+            key = UUID(uuid).bytes
+        except ValueError:
+            return None
+        mask = self._table_size - 1
+        slot = int.from_bytes(key[:8], 'little') & mask
+        while True:
+            i = self._u32('uuid_table', slot)
+            if not i:
+                return None
+            if self._uuid(i - 1) == key:
+                return i - 1
+            slot = (slot + 1) & mask
+
+    def get(self, uuid, default=None):
+        """Return an image's record by UUID, or `default`."""
+        i = self.find(uuid)
+        return default if i is None else self[i]
+
+
+def convert(json_file, bin_file=None):
+    """Convert an orca_v1 index.json to index.bin (next to it by default)."""
+    import json
+
+    json_file = Path(json_file)
+    bin_file = Path(bin_file) if bin_file else json_file.with_suffix('.bin')
+    with json_file.open() as f:
+        index = json.load(f)
+    if index.get('schema') != 'orca_v1':
+        raise ValueError(f"Unsupported index schema: {index.get('schema')}")
+    header = write_binindex(index, bin_file)
+    log.info(
+        'Converted %d images in %d albums: %s (%d bytes) -> %s (%d bytes).'
+        % (
+            header['doc_count'],
+            header['album_count'],
+            json_file,
+            json_file.stat().st_size,
+            bin_file,
+            bin_file.stat().st_size,
+        )
+    )
+    return bin_file
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+    )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('json_file')
+    parser.add_argument('-o', '--bin_file')
+    args = parser.parse_args()
+
+    convert(args.json_file, args.bin_file)
+    log.info('Done!')
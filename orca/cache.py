@@ -0,0 +1,146 @@
+"""
+Size and age limits for cached search results, megadocs and megadoc page
+fragments.
+
+Set ORCA_CACHE_BUDGET_MB to cap how much disk they can use together and
+ORCA_CACHE_MAX_AGE_DAYS to drop anything that hasn't been used in a while.
+Least recently used searches and fragments go first; searches that are still
+running or still have megadocs being built are never evicted. Fragments are
+tracked in the registry as megadocs use them, so nothing has to walk the
+fragment cache to find out how big it is.
+"""
+
+import logging
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+def _files(search_info):
+    files = [Path(search_info['results']['json_path'])]
+    for megadoc_info in search_info.get('megadocs', []):
+        # Megadocs split into volumes only point to a download URL.
+        doc_files = [Path(v['path']) for v in megadoc_info.get('volumes', [])]
+        if 'volumes' not in megadoc_info:
+            doc_files.append(Path(megadoc_info['path']))
+        for doc_file in doc_files:
+            files += [doc_file, doc_file.with_stem(f"INCOMPLETE_{doc_file.stem}")]
+    return files
+
+
+def _size(search_info):
+    size = 0
+    for f in _files(search_info):
+        try:
+            size += f.stat().st_size
+        except FileNotFoundError:
+            pass
+    return size
+
+
+def import_fragments(batch_path):
+    """
+    Record every fragment already in a batch's fragment cache in the
+    registry, for caches from before fragments were tracked there. Returns
+    the number of fragments found.
+    """
+    from orca.registry import record_fragments
+
+    fragment_path = Path(batch_path) / 'cache' / 'fragments'
+    fragments = []
+    for f in fragment_path.glob('*/*'):
+        # Skip fragments that are still being written.
+        if f.name.startswith('.'):
+            continue
+        try:
+            fragments.append((f.relative_to(fragment_path).as_posix(), f.stat().st_size))
+        except FileNotFoundError:
+            continue
+    record_fragments(batch_path, fragments)
+    return len(fragments)
+
+
+def _in_progress(search_info):
+    return not search_info['results']['complete'] or any(
+        not d['complete'] for d in search_info.get('megadocs', [])
+    )
+
+
+def remove_search(batch_path, search_info, reason='evictions'):
+    """
+    Delete a search's results and megadocs and drop it from the registry,
+    counting it under `reason`.
+    """
+    from orca.registry import count, delete_search
+
+    for f in _files(search_info):
+        f.unlink(missing_ok=True)
+    delete_search(batch_path, search_info['uuid'])
+    count(batch_path, reason)
+
+
+def evict(batch_path, budget_mb=None, max_age_days=None):
+    """
+    Remove cached searches and page fragments, least recently used first,
+    until the cache fits its budget, as well as any that are older than the
+    maximum age. Returns the number of searches removed.
+    """
+    import os
+    from time import time
+    from orca.registry import (
+        count,
+        delete_fragments,
+        fragment_usage,
+        get_stats,
+        list_fragments,
+        list_lru,
+    )
+
+    if budget_mb is None and os.getenv('ORCA_CACHE_BUDGET_MB'):
+        budget_mb = float(os.getenv('ORCA_CACHE_BUDGET_MB'))
+    if max_age_days is None and os.getenv('ORCA_CACHE_MAX_AGE_DAYS'):
+        max_age_days = float(os.getenv('ORCA_CACHE_MAX_AGE_DAYS'))
+    if budget_mb is None and max_age_days is None:
+        return 0
+
+    # Fragments cached before the registry tracked them are found once.
+    if not get_stats(batch_path).get('fragment_imports'):
+        import_fragments(batch_path)
+        count(batch_path, 'fragment_imports')
+
+    entries = [
+        (last_used, search_info, _size(search_info))
+        for last_used, search_info in list_lru(batch_path)
+    ]
+    total = sum(size for _, _, size in entries) + fragment_usage(batch_path)[1]
+    budget = budget_mb * 1024 * 1024 if budget_mb is not None else float('inf')
+    oldest = time() - max_age_days * 86400 if max_age_days is not None else 0.0
+
+    # Searches and fragments share the budget, so evict them in one order.
+    # Every fragment is only listed when the budget has to be made up.
+    fragment_path = Path(batch_path) / 'cache' / 'fragments'
+    fragments = list_fragments(batch_path, None if total > budget else oldest)
+    entries += [(last_used, fragment_path / name, size) for last_used, name, size in fragments]
+    entries.sort(key=lambda e: e[0])
+
+    removed = 0
+    fragments_removed = []
+    for last_used, entry, size in entries:
+        if total <= budget and last_used >= oldest:
+            continue
+        if isinstance(entry, Path):
+            # Megadocs being built fall back to the text if a fragment goes.
+            entry.unlink(missing_ok=True)
+            total -= size
+            fragments_removed.append(entry.relative_to(fragment_path).as_posix())
+            continue
+        if _in_progress(entry):
+            continue
+        log.info('Evicting search "%s" (%d bytes).' % (entry['query_str'], size))
+        remove_search(batch_path, entry)
+        total -= size
+        removed += 1
+    if fragments_removed:
+        delete_fragments(batch_path, fragments_removed)
+        log.info('Evicted %d page fragments.' % len(fragments_removed))
+    return removed
@@ -58,28 +58,304 @@ def login(username='', password=''):
     return api
 
 
-def album_sort(years, months, api):
-    """TODO: Description."""
+def _add_photos(album, album_name, photos):
+    """
+    Add photos to an album and return the ones that were added, logging any
+    that weren't.
+    """
+    added = []
+    for photo in photos:
+        try:
+            ok = album.add_photo(photo)
+        except Exception as e:
+            log.warning('Failed to add %s to %s: %s' % (photo.filename, album_name, e))
+            continue
+        if ok:
+            added.append(photo)
+        else:
+            log.warning('Failed to add %s to %s.' % (photo.filename, album_name))
+    return added
+
+
+def album_sort(
+    years,
+    months,
+    api,
+    state_file=None,
+    batch_size=100,
+    stop_after=200,
+    dry_run=False,
+):
+    """
+    Add photos from "Recents" to a "<Month> <Year>" album for each of the
+    given years and months.
+
+    The IDs of photos added to an album are appended to a log next to
+    `state_file` (by default `$ORCA_ICLOUD_SORT_STATE`, or album_sort.json)
+    after every batch, so a rerun skips them; photos that failed to be added
+    are tried again. A run that gets to the end without failures saves the
+    newest date a photo was added to the library, for the same years and
+    months, to `state_file`; while the album keeps coming newest first, the
+    next run stops after `stop_after` photos in a row that were added no
+    later than that. With `dry_run`, nothing is added or saved, but the
+    stats are still reported.
+    """
+    import json
+    import time
+    from collections import defaultdict
     from datetime import datetime
 
-    for i, photo in enumerate(api.photos.albums['Recents']):
+    state_file = Path(
+        state_file or os.getenv('ORCA_ICLOUD_SORT_STATE', 'album_sort.json')
+    )
+    processed_file = state_file.with_name(f"{state_file.stem}.processed")
+    try:
+        with state_file.open() as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {}
+    try:
+        with processed_file.open() as f:
+            processed = {line.strip() for line in f if line.strip()}
+    except FileNotFoundError:
+        processed = set()
+
+    def save_state():
+        tmp_file = state_file.with_name(f"{state_file.name}.tmp")
+        with tmp_file.open('w') as f:
+            json.dump({'high_water': high_waters}, f)
+        tmp_file.replace(state_file)
+
+    high_waters = state.get('high_water', {})
+    if state.get('processed') and not dry_run:
+        # Move IDs out of state files from before the log existed.
+        with processed_file.open('a') as f:
+            f.writelines(f"{photo_id}\n" for photo_id in state['processed'])
+        save_state()
+    processed.update(state.get('processed', []))
+    selection = f"{sorted(years)}:{sorted(months)}"
+    high_water = high_waters.get(selection)
+    high_water = high_water and datetime.fromisoformat(high_water)
+    log.info('%d photos already sorted.' % len(processed))
+
+    recents = api.photos.albums['Recents']
+
+    albums = {}
+    pending = defaultdict(list)
+    stats = {'scanned': 0, 'skipped': 0, 'added': 0, 'unmatched': 0, 'failed': 0}
+    start = time.perf_counter()
+
+    def flush():
+        added = []
+        for album_name, photos in pending.items():
+            if album_name not in albums:
+                albums[album_name] = api.photos.albums[album_name]
+            if not dry_run:
+                photos_added = _add_photos(albums[album_name], album_name, photos)
+            else:
+                photos_added = photos
+            added += photos_added
+            stats['failed'] += len(photos) - len(photos_added)
+            log.info('Added %d photos to %s.' % (len(photos_added), album_name))
+        pending.clear()
+        processed.update(photo.id for photo in added)
+        stats['added'] += len(added)
+        if added and not dry_run:
+            with processed_file.open('a') as f:
+                f.writelines(f"{photo.id}\n" for photo in added)
+
+    # Only stop early while the photos have actually come newest first: the
+    # order the album is walked in isn't part of pyicloud's API.
+    newest = high_water
+    previous = None
+    newest_first = True
+    seen_in_a_row = 0
+    for i, photo in enumerate(recents):
+        stats['scanned'] += 1
+        added = getattr(photo, 'added_date', None)
+        if added is None or (previous is not None and added > previous):
+            newest_first = False
+        if added is not None:
+            previous = added
+            newest = added if newest is None or added > newest else newest
+        if high_water and added is not None and added <= high_water:
+            seen_in_a_row += 1
+            if stop_after and newest_first and seen_in_a_row >= stop_after:
+                log.info('[%d] Reached photos added before the last run.' % (i + 1))
+                break
+        else:
+            seen_in_a_row = 0
+
+        if photo.id in processed:
+            stats['skipped'] += 1
+            continue
 
-        is_match = False
         year = photo.created.year
         month = photo.created.month
         if year in years and month in months:
-            is_match = True
             album_name = datetime(year, month, 1).strftime('%B %Y')
-            album = api.photos.albums[album_name]
-            album.add(photo)
-
-        if is_match:
-            log.info('[%d] %s -> %s' % (i + 1, photo.filename, album_name))
+            pending[album_name].append(photo)
+            log.debug('[%d] %s -> %s' % (i + 1, photo.filename, album_name))
+            if sum(len(photos) for photos in pending.values()) >= batch_size:
+                flush()
         else:
-            log.info('[%d] %s (no match)' % (i + 1, photo.filename))
+            stats['unmatched'] += 1
+            log.debug('[%d] %s (no match)' % (i + 1, photo.filename))
+
+    flush()
+
+    # Everything added up to the newest photo has now been looked at, unless
+    # some of it failed and has to be found again next time.
+    if newest is not None and not stats['failed'] and not dry_run:
+        high_waters[selection] = newest.isoformat()
+        save_state()
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    log.info(
+        '%sScanned %d photos (%d already sorted, %d unmatched) and added %d '
+        '(%d failed) in %.1f seconds (%.1f scanned/sec, %.1f added/sec).'
+        % (
+            '[dry run] ' if dry_run else '',
+            stats['scanned'],
+            stats['skipped'],
+            stats['unmatched'],
+            stats['added'],
+            stats['failed'],
+            elapsed,
+            stats['scanned'] / elapsed,
+            stats['added'] / elapsed,
+        )
+    )
+    return stats
 
 
-def download_by_album(dl_path, album_name, api, retry_max=3, retry_delay=60.0):
+class _Backoff:
+    """
+    Exponential backoff with jitter, shared by all download workers so that
+    when iCloud starts throttling everyone slows down, and recovers together.
+    """
+
+    def __init__(self, base_delay, max_delay):
+        import threading
+
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Sleep until the shared backoff (if any) has passed."""
+        import time
+
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def fail(self):
+        """Record a throttled request and return how long to back off for."""
+        import random
+        import time
+
+        with self.lock:
+            self.failures += 1
+            cap = min(self.max_delay, self.base_delay * 2 ** (self.failures - 1))
+            delay = random.uniform(cap / 2, cap)
+            self.resume_at = max(self.resume_at, time.monotonic() + delay)
+            return delay
+
+    def succeed(self):
+        """Record a successful request, easing off the backoff."""
+        with self.lock:
+            self.failures = max(0, self.failures - 1)
+
+
+def load_checkpoint(checkpoint_file):
+    """Return the photos already downloaded, as {photo ID: filename}."""
+    import json
+
+    try:
+        with open(checkpoint_file) as f:
+            return json.load(f).get('done', {})
+    except FileNotFoundError:
+        return {}
+    except json.decoder.JSONDecodeError:
+        log.warning('Ignoring corrupt checkpoint: %s' % checkpoint_file)
+        return {}
+
+
+def save_checkpoint(checkpoint_file, album_name, done):
+    """Atomically save the photos downloaded so far."""
+    import json
+
+    checkpoint_file = Path(checkpoint_file)
+    tmp_file = checkpoint_file.with_name(f"{checkpoint_file.name}.tmp")
+    with tmp_file.open('w') as f:
+        json.dump({'album_name': album_name, 'done': done}, f)
+    tmp_file.replace(checkpoint_file)
+
+
+def download_photo(photo, img_file, backoff, retry_max=3):
+    """
+    Download one photo to `img_file` and return the number of bytes written.
+
+    The photo is written to a `.part` file that only replaces `img_file` once
+    it is complete and its size matches what iCloud reports, so an
+    interrupted download never looks finished.
+    """
+    import time
+    from pyicloud.exceptions import PyiCloudAPIResponseException
+
+    part_file = img_file.with_name(f"{img_file.name}.part")
+    expected = getattr(photo, 'size', None)
+    for attempt in range(retry_max + 1):
+        backoff.wait()
+        try:
+            download = photo.download()
+            if download is None:
+                raise IOError(f"No download URL for {photo.filename}")
+
+            # Buffer so we don't have to keep the whole thing in RAM.
+            with part_file.open('wb') as f:
+                if hasattr(download, 'iter_content'):
+                    for chunk in download.iter_content(chunk_size=1024 * 1024):
+                        if chunk:
+                            f.write(chunk)
+                else:
+                    f.write(download)
+            size = part_file.stat().st_size
+            if expected and size != expected:
+                raise IOError(f"Expected {expected} bytes, got {size}")
+            backoff.succeed()
+            break
+        except (PyiCloudAPIResponseException, IOError) as e:
+            part_file.unlink(missing_ok=True)
+            if attempt == retry_max:
+                raise
+            delay = backoff.fail()
+            log.warning(
+                '%s: %s. Retrying in %.1f seconds (%d/%d)...'
+                % (photo.filename, e, delay, attempt + 1, retry_max)
+            )
+            time.sleep(delay)
+
+    # Overwrite filesystem timestamp with iCloud's "created on" property,
+    # just as another way to help sort them if necessary.
+    timestamp = time.mktime(photo.created.timetuple())
+    os.utime(part_file, (timestamp, timestamp))
+    part_file.replace(img_file)
+    return size
+
+
+def download_by_album(
+    dl_path,
+    album_name,
+    api,
+    retry_max=3,
+    retry_delay=60.0,
+    workers=4,
+    max_delay=600.0,
+):
     """
     Download photos from an album and save them to the specified path.
 
@@ -87,9 +363,13 @@ def download_by_album(dl_path, album_name, api, retry_max=3, retry_delay=60.0):
     filename to help sort them by the order they were taken. The filesystem
     timestamps are also adjusted to reflect the "created on" property from
     iCloud, providing an additional way to sort the photos.
+
+    Up to `workers` photos are downloaded at once. Finished photos are
+    recorded in a checkpoint file in `dl_path`, so an interrupted run picks
+    up where it left off.
     """
     import time
-    from pyicloud.exceptions import PyiCloudAPIResponseException
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
     dl_path = Path(dl_path)
     album = api.photos.albums.get(album_name)
@@ -98,65 +378,104 @@ def download_by_album(dl_path, album_name, api, retry_max=3, retry_delay=60.0):
         return None
 
     count = len(album)
-    dl_count = 0
     log.info('Downloading %d photos from album "%s"...' % (count, album_name))
     dl_path.mkdir(exist_ok=True, parents=True)
-    for i, photo in enumerate(album):
-        count_str = '[%d/%d]' % (i + 1, count)
+    checkpoint_file = dl_path / '.orca_download.json'
+    done = load_checkpoint(checkpoint_file)
+    backoff = _Backoff(retry_delay, max_delay)
+    stats = {'count': count, 'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+    start = time.perf_counter()
 
-        # Skip .MOV files.
-        if photo.filename.lower().endswith('.mov'):
-            log.info('%s: Video, skipping: %s' % (count_str, photo.filename))
-            continue
+    def log_progress(i, final=False):
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        log.info(
+            '%s %d downloaded, %d skipped, %d failed (%.2f MB/s, %.1f photos/min).'
+            % (
+                'Done!' if final else f"[{i}/{count}]",
+                stats['downloaded'],
+                stats['skipped'],
+                stats['failed'],
+                stats['bytes'] / elapsed / 1024 / 1024,
+                stats['downloaded'] / elapsed * 60,
+            )
+        )
 
-        # Build filename.
-        index = f"{(i + 1):06}"
-        timestamp = photo.created.strftime('%Y-%m-%d_%H-%M-%S')
-        name = photo.filename
-        img_file = dl_path / f"{index}_{timestamp}_{name}"
-        if img_file.exists():
-            log.info('%s: Already exists, skipping: %s' % (count_str, img_file))
-            continue
+    def finish(future):
+        photo, img_file = pending.pop(future)
+        try:
+            stats['bytes'] += future.result()
+            stats['downloaded'] += 1
+            done[photo.id] = img_file.name
+        except Exception as e:
+            stats['failed'] += 1
+            log.error('Giving up on %s: %s' % (img_file.name, e))
+        n = stats['downloaded'] + stats['failed']
+        if n % 100 == 0:
+            save_checkpoint(checkpoint_file, album_name, done)
+            log_progress(n + stats['skipped'])
 
-        # Download photo.
-        if i == 0 or i % 100 == 99 or i == count - 1:
-            log.info('%s: %s' % (count_str, img_file))
-        else:
-            log.debug('%s: %s' % (count_str, img_file))
-        attempt = 0
-        while attempt == 0 or attempt < retry_max:
-            try:
-                download = photo.download()
-                break
-            except PyiCloudAPIResponseException:
-                log.warning('Failed with code 503.')
-                if attempt < retry_max:
-                    log.info(
-                        'Retrying in %f seconds (%d/%d)...'
-                        % (retry_delay, attempt + 1, retry_max)
-                    )
-                    attempt += 1
-                    time.sleep(retry_delay)
-
-        # Buffer so we don't have to keep the whole thing in RAM.
-        with img_file.open('wb') as f:
-            for chunk in download.iter_content(chunk_size=1024 * 1024):
-                if chunk:
-                    f.write(chunk)
-        dl_count += 1
-
-        # Overwrite filesystem timestamp with iCloud's "created on" property,
-        # just as another way to help sort them if necessary.
-        timestamp = time.mktime(photo.created.timetuple())
-        os.utime(img_file, (timestamp, timestamp))
-
-    log.info('Done! Got %d of %d photos from "%s."' % (dl_count, count, album_name))
+    pending = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for i, photo in enumerate(album):
+                count_str = '[%d/%d]' % (i + 1, count)
+
+                # Skip .MOV files.
+                if photo.filename.lower().endswith('.mov'):
+                    log.info('%s: Video, skipping: %s' % (count_str, photo.filename))
+                    stats['skipped'] += 1
+                    continue
+
+                # Build filename.
+                index = f"{(i + 1):06}"
+                timestamp = photo.created.strftime('%Y-%m-%d_%H-%M-%S')
+                name = photo.filename
+                img_file = dl_path / f"{index}_{timestamp}_{name}"
+                if done.get(photo.id) == img_file.name and img_file.exists():
+                    log.debug('%s: Already downloaded: %s' % (count_str, img_file))
+                    stats['skipped'] += 1
+                    continue
+                size = getattr(photo, 'size', None)
+                if img_file.exists() and (not size or img_file.stat().st_size == size):
+                    log.info('%s: Already exists, skipping: %s' % (count_str, img_file))
+                    done[photo.id] = img_file.name
+                    stats['skipped'] += 1
+                    continue
+
+                log.debug('%s: %s' % (count_str, img_file))
+                # Keep a bounded number of downloads queued so that listing
+                # the album doesn't run far ahead of the workers.
+                while len(pending) >= workers * 2:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        finish(future)
+                future = executor.submit(download_photo, photo, img_file, backoff, retry_max)
+                pending[future] = (photo, img_file)
+
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    finish(future)
+        finally:
+            for future in list(pending):
+                future.cancel()
+            save_checkpoint(checkpoint_file, album_name, done)
+
+    log_progress(count, final=True)
+    return stats
 
 
 if __name__ == '__main__':
+    import argparse
+
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s',
     )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--dry_run', action='store_true')
+    args = parser.parse_args()
+
     api = login()
-    album_sort([2023], [7, 8, 9], api)
+    album_sort([2023], [7, 8, 9], api, dry_run=args.dry_run)
@@ -6,7 +6,7 @@ from pathlib import Path
 log = logging.getLogger(__name__)
 
 
-def load_img_data(img, batch):
+def load_img_data(img, batch, img_uuid=None):
     """TODO: Description."""
     from uuid import uuid4
     from dateutil.parser import parse
@@ -20,7 +20,7 @@ def load_img_data(img, batch):
     img_ts_str = img_ts.strftime('%B %d, %Y at %-I:%M %p')
     img_title = "_".join(img_split[3:])
 
-    img_uuid = uuid4()
+    img_uuid = img_uuid or uuid4()
 
     album_path = img.parent
     album = f"{album_path.name}"
@@ -52,8 +52,69 @@ def load_img_data(img, batch):
     return img_data
 
 
-def make_index(batch):
-    """TODO: Description."""
+def is_image_file(path):
+    """
+    Return whether a file in the image tree is an image, and not a download
+    checkpoint, a half-downloaded `.part` file or some other hidden file.
+    """
+    path = Path(path)
+    return path.is_file() and not path.name.startswith('.') and path.suffix != '.part'
+
+
+def load_manifest(batch):
+    """
+    Load the manifest from the last index build: a map of image path to the
+    file's mtime, size and the UUID it was given.
+    """
+    import json
+
+    manifest_file = Path(batch) / 'cache' / 'manifest.json'
+    if not manifest_file.is_file():
+        return {}
+    try:
+        with manifest_file.open() as f:
+            return json.load(f)
+    except json.decoder.JSONDecodeError:
+        log.error('Error loading manifest, starting over: %s' % manifest_file)
+        return {}
+
+
+def save_index(index, manifest=None):
+    """
+    Write the index (and manifest, if given) to the batch cache, along with
+    its compact binary form, index.bin.
+    """
+    import json
+    from orca.binindex import write_binindex
+
+    cache_path = Path(index['cache_path'])
+    cache_path.mkdir(parents=True, exist_ok=True)
+    files = [(cache_path / 'index.json', index)]
+    if manifest is not None:
+        files.append((cache_path / 'manifest.json', manifest))
+    for out_file, data in files:
+        tmp_file = out_file.with_name(f".{out_file.name}.tmp")
+        with tmp_file.open('w') as f:
+            json.dump(data, f)
+        tmp_file.replace(out_file)
+    write_binindex(index, cache_path / 'index.bin')
+
+
+def make_index(batch, incremental=False, workers=1):
+    """
+    Index image metadata for a batch and return the index along with a
+    manifest of what was indexed.
+
+    Images keep the UUIDs they were given the last time the batch was indexed.
+    With `incremental`, metadata from the previous index is also reused for
+    any image whose mtime and size haven't changed and whose JSON and TXT files
+    were already found; only new or changed images get loaded again. Loading
+    is spread across `workers` processes if more than one is given.
+    """
+    import json
+    from concurrent.futures import ProcessPoolExecutor
+    from hashlib import sha1
+    from itertools import repeat
     from uuid import uuid4
     from datetime import datetime
     from natsort import natsorted
@@ -64,43 +125,179 @@ def make_index(batch):
     img_path = data_path / 'img'
 
     log.info('Loading images for %s...' % batch)
-    img_files = natsorted([f for f in img_path.glob('**/*.*') if f.is_file()])
+    img_files = natsorted([f for f in img_path.glob('**/*.*') if is_image_file(f)])
     log.info('Found %d images. Indexing metadata...' % len(img_files))
 
+    # Pick up UUIDs and, if we can, metadata from the last run.
+    old_manifest = load_manifest(batch)
+    old_images = {}
+    index_file = cache_path / 'index.json'
+    if incremental and old_manifest and index_file.is_file():
+        with index_file.open() as f:
+            old_images = {img['path']: img for img in json.load(f)['images']}
+
+    manifest = {}
+    images = {}
+    todo = []
+    for img in img_files:
+        path = f"{img}"
+        stat = img.stat()
+        entry = old_manifest.get(path, {})
+        manifest[path] = {
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'uuid': entry.get('uuid') or f"{uuid4()}",
+        }
+
+        old_img = old_images.get(path)
+        if (
+            old_img
+            and old_img['uuid'] == manifest[path]['uuid']
+            and old_img['json_path']
+            and old_img['txt_path']
+            and entry.get('mtime') == stat.st_mtime_ns
+            and entry.get('size') == stat.st_size
+        ):
+            images[path] = old_img
+        else:
+            todo.append(img)
+
+    log.info(
+        'Reusing metadata for %d images, loading %d...'
+        % (len(images), len(todo))
+    )
+    uuids = [manifest[f"{img}"]['uuid'] for img in todo]
+    if workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(todo) // (workers * 4))
+            loaded = pool.map(
+                load_img_data, todo, repeat(batch), uuids, chunksize=chunksize
+            )
+            for i, img_data in enumerate(loaded):
+                log.debug('[%d/%d] %s' % (i + 1, len(todo), img_data['path']))
+                images[img_data['path']] = img_data
+    else:
+        for i, (img, img_uuid) in enumerate(zip(todo, uuids)):
+            log.debug('[%d/%d] %s' % (i + 1, len(todo), img))
+            images[f"{img}"] = load_img_data(img, batch, img_uuid)
+
+    # The version only changes when the images do, unlike the UUID, which
+    # is new for every build.
+    version = sha1(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()
     index = {
         'schema': "orca_v1",
         'uuid': f"{uuid4()}",
+        'version': version,
         'batch': f"{batch.name}",
         'cache_path': f"{cache_path}",
         'timestamp': datetime.now().isoformat(),
-        'images': [],
+        'albums': {},
+        'images': [images[f"{img}"] for img in img_files],
     }
-    for i, img in enumerate(img_files):
-        log.debug('[%d/%d] %s' % (i + 1, len(img_files), img))
-        img_data = load_img_data(img, batch)
-        index['images'].append(img_data)
-
-    return index
-
-
-def make_whoosh_index(index):
-    """TODO: Description."""
-    from whoosh.fields import Schema, TEXT, ID
-    from whoosh.index import create_in
+    index['albums'] = make_album_stats(index['images'])
+    return index, manifest
+
+
+def make_album_stats(images):
+    """
+    Work out per-album statistics from indexed images (in index order) and
+    return them keyed by album: title, path, image count and date range. Each
+    image also gets its ordinal `album_position` and the `album_count`, so
+    nothing downstream has to go back to the filesystem for them.
+    """
+    albums = {}
+    for img in images:
+        album = albums.get(img['album'])
+        if album is None:
+            album = albums[img['album']] = {
+                'title': img['album_title'],
+                'path': img['album_path'],
+                'count': 0,
+                'first_timestamp': img['timestamp'],
+                'last_timestamp': img['timestamp'],
+            }
+        album['count'] += 1
+        album['first_timestamp'] = min(album['first_timestamp'], img['timestamp'])
+        album['last_timestamp'] = max(album['last_timestamp'], img['timestamp'])
+        img['album_position'] = album['count']
+
+    for img in images:
+        img['album_count'] = albums[img['album']]['count']
+    return albums
+
+
+def make_whoosh_index(index, procs=1, limitmb=128, multisegment=False, update=False):
+    """
+    Build the Whoosh full-text index for a batch and return a count of the
+    documents added, updated, deleted and left unchanged.
+
+    With `procs` > 1 documents are indexed by Whoosh's multiprocessing writer,
+    each process using up to `limitmb` MB; `multisegment` skips the final merge
+    and leaves one segment per process. With `update`, an existing index is
+    kept and only documents whose OCR text changed (tracked by a `version`
+    term of UUID and TXT mtime) are replaced, and documents no longer in the
+    image index are deleted.
+
+    Each document also has the image's `timestamp`, `album` and `index`, so
+    searches can be narrowed by album or date in Whoosh itself. The spelling
+    index for tolerant searches is updated with the words that changed.
+    """
+    from datetime import datetime
+    from time import perf_counter
+    from whoosh.fields import Schema, DATETIME, ID, KEYWORD, NUMERIC, TEXT
+    from whoosh.index import create_in, exists_in, open_dir
     from whoosh.writing import AsyncWriter
+    from orca.spelling import spelling_path, update_spelling_index
 
     whoosh_index_path = Path(index['cache_path']) / 'whoosh'
     whoosh_index_path.mkdir(parents=True, exist_ok=True)
-    log.info('Creating Whoosh index in %s...' % whoosh_index_path)
 
     schema = Schema(
         uuid=ID(stored=True, unique=True),
+        version=ID,
         content=TEXT(stored=True),
+        timestamp=DATETIME(sortable=True),
+        album=KEYWORD(commas=True),
+        index=NUMERIC(int),
     )
 
-    whoosh_index = create_in(whoosh_index_path.as_posix(), schema)
-    writer = AsyncWriter(whoosh_index)
-
+    # Find out what's already indexed if we're updating.
+    whoosh_index = None
+    versions = {}
+    if update and exists_in(whoosh_index_path.as_posix()):
+        whoosh_index = open_dir(whoosh_index_path.as_posix())
+        if all(name in whoosh_index.schema for name in schema.names()):
+            log.info('Updating Whoosh index in %s...' % whoosh_index_path)
+            with whoosh_index.reader() as reader:
+                # Terms of deleted documents stay in the lexicon until the
+                # segment is merged, so skip any that no longer have a live
+                # document.
+                has_deletions = reader.has_deletions()
+                for version in reader.lexicon('version'):
+                    if has_deletions and all(
+                        reader.is_deleted(docnum)
+                        for docnum in reader.postings('version', version).all_ids()
+                    ):
+                        continue
+                    uuid, _, mtime = version.decode('utf-8').rpartition(':')
+                    versions[uuid] = mtime
+        else:
+            log.warning('Whoosh index has an old schema, rebuilding it.')
+            whoosh_index = None
+    if whoosh_index is None:
+        log.info('Creating Whoosh index in %s...' % whoosh_index_path)
+        whoosh_index = create_in(whoosh_index_path.as_posix(), schema)
+
+    if procs > 1:
+        writer = whoosh_index.writer(
+            procs=procs, limitmb=limitmb, multisegment=multisegment
+        )
+    else:
+        writer = AsyncWriter(whoosh_index, writerargs={'limitmb': limitmb})
+
+    stats = {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    indexed = set()
+    start = perf_counter()
     for i, img in enumerate(index['images']):
         log.debug('[%d/%d] %s' % (i + 1, len(index['images']), img['path']))
 
@@ -114,18 +311,70 @@ def make_whoosh_index(index):
             log.warning('Skipping, TXT file not found: %s' % img['path'])
             continue
 
+        # Skip documents that haven't changed since the last build.
+        indexed.add(img['uuid'])
+        mtime = f"{txt_file.stat().st_mtime_ns}"
+        if versions.get(img['uuid']) == mtime:
+            stats['unchanged'] += 1
+            continue
+
         # Load content.
         with txt_file.open() as f:
             content = f.read()
-        writer.add_document(uuid=img['uuid'], content=content)
+        doc = {
+            'uuid': img['uuid'],
+            'version': f"{img['uuid']}:{mtime}",
+            'content': content,
+            'timestamp': datetime.fromisoformat(img['timestamp']),
+            'album': img['album'],
+            'index': img['index'],
+        }
+        if img['uuid'] in versions:
+            writer.update_document(**doc)
+            stats['updated'] += 1
+        else:
+            writer.add_document(**doc)
+            stats['added'] += 1
+
+    for uuid in versions.keys() - indexed:
+        writer.delete_by_term('uuid', uuid)
+        stats['deleted'] += 1
+
+    if update and not (stats['added'] or stats['updated'] or stats['deleted']):
+        # Committing would start a new generation for nothing.
+        log.info('Whoosh index is up to date: %s' % whoosh_index_path)
+        writer.cancel()
+    else:
+        log.info('Saving Whoosh index to %s...' % whoosh_index_path)
+        writer.commit()
+
+    elapsed = perf_counter() - start
+    written = stats['added'] + stats['updated']
+    log.info(
+        'Indexed %d documents in %.2f seconds (%.1f docs/sec); '
+        '%d added, %d updated, %d deleted, %d unchanged.'
+        % (
+            written,
+            elapsed,
+            written / max(elapsed, 1e-9),
+            stats['added'],
+            stats['updated'],
+            stats['deleted'],
+            stats['unchanged'],
+        )
+    )
 
-    log.info('Saving Whoosh index to %s...' % whoosh_index_path)
-    writer.commit()
+    # Update the spelling index for tolerant searches if the lexicon may
+    # have changed.
+    spelling_file = spelling_path(Path(index['cache_path']).parent)
+    if stats['added'] or stats['updated'] or stats['deleted'] or not spelling_file.is_file():
+        with whoosh_index.reader() as reader:
+            update_spelling_index(reader, spelling_file)
+    return stats
 
 
 if __name__ == '__main__':
     import argparse
-    import json
 
     logging.basicConfig(
         level=logging.INFO,
@@ -134,18 +383,23 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('batch_path')
+    parser.add_argument('-i', '--incremental', action='store_true')
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-p', '--procs', type=int, default=1)
+    parser.add_argument('-m', '--limitmb', type=int, default=128)
+    parser.add_argument('-s', '--multisegment', action='store_true')
     args = parser.parse_args()
 
-    # Make index from batch.
+    # Make index from batch and save it to file.
     batch_path = Path(args.batch_path)
-    index = make_index(batch_path)
-
-    # Save index to file.
-    cache_path = Path(index['cache_path'])
-    cache_path.mkdir(parents=True, exist_ok=True)
-    index_file = cache_path / 'index.json'
-    with index_file.open('w') as f:
-        json.dump(index, f)
-
-    # Make Whoosh index.
-    make_whoosh_index(index)
+    index, manifest = make_index(batch_path, args.incremental, args.workers)
+    save_index(index, manifest)
+
+    # Make Whoosh index. Incremental runs only update what changed.
+    make_whoosh_index(
+        index,
+        procs=args.procs,
+        limitmb=args.limitmb,
+        multisegment=args.multisegment,
+        update=args.incremental,
+    )
@@ -6,151 +6,647 @@ from pathlib import Path
 log = logging.getLogger(__name__)
 
 
-def build_md(images, out_file):
-    """TODO: Description."""
-    from docx import Document
-    from docx.oxml import OxmlElement
-    from docx.oxml.ns import qn
+DOCX_HYPERLINK = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/hyperlink'
+
+
+def _docx_run_text(text):
+    """
+    Convert text to the contents of a <w:r> element the same way python-docx
+    does: tabs and line breaks become <w:tab/> and <w:br/>, and characters
+    XML can't hold are dropped.
+    """
+    import re
+    from xml.sax.saxutils import escape
+
+    text = re.sub('[\x00-\x08\x0b\x0c\x0e-\x1f]', '', text)
+    parts = []
+    for piece in re.split('([\t\n\r])', text):
+        if piece == '\t':
+            parts.append('<w:tab/>')
+        elif piece in ('\n', '\r'):
+            parts.append('<w:br/>')
+        elif piece:
+            space = ' xml:space="preserve"' if piece != piece.strip() else ''
+            parts.append(f"<w:t{space}>{escape(piece)}</w:t>")
+    return ''.join(parts)
+
+
+class DocxWriter:
+    """
+    Write a .docx megadoc in a single pass.
+
+    The package parts come from python-docx's default template, but the body
+    of word/document.xml is streamed straight into the zip one page at a time
+    and hyperlink relationships are spooled to a temporary file, so memory use
+    doesn't grow with the size of the document and nothing is ever re-parsed.
+    """
+
+    def __init__(self, out_file):
+        import io
+        import tempfile
+        from zipfile import ZipFile, ZIP_DEFLATED
+        from docx import Document
+
+        template = io.BytesIO()
+        Document().save(template)
+
+        self._zip = ZipFile(out_file, 'w', ZIP_DEFLATED)
+        with ZipFile(template) as t:
+            for item in t.infolist():
+                if item.filename == 'word/document.xml':
+                    doc_xml = t.read(item).decode('utf-8')
+                elif item.filename == 'word/_rels/document.xml.rels':
+                    rels_xml = t.read(item).decode('utf-8')
+                else:
+                    self._zip.writestr(item, t.read(item))
+
+        # Everything up to <w:body> goes first; the section properties and
+        # closing tags are held back until all the pages are in.
+        body_start = doc_xml.index('<w:body>') + len('<w:body>')
+        self._doc_tail = doc_xml[body_start:]
+        self._rels_head = rels_xml[: rels_xml.rindex('</Relationships>')]
+        self._rels = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self._body = io.TextIOWrapper(
+            self._zip.open('word/document.xml', 'w'), encoding='utf-8'
+        )
+        self._body.write(doc_xml[:body_start])
+        self.pages = 0
+
+    def _relate_to(self, url):
+        from xml.sax.saxutils import quoteattr
+
+        r_id = f"rIdOrca{self.pages}"
+        self._rels.write(
+            f'<Relationship Id="{r_id}" Type="{DOCX_HYPERLINK}" '
+            f'Target={quoteattr(url)} TargetMode="External"/>'
+        )
+        return r_id
+
+    # Stands in for the hyperlink's relationship ID in rendered pages.
+    RID = 'rIdOrcaPage'
+    extension = 'xml'
+
+    @classmethod
+    def render(cls, heading, album_index, url, content):
+        """Render one page to OOXML: heading, album line, link and OCR text."""
+        album_line = _docx_run_text(f"{album_index}\n")
+        return (
+            '<w:p><w:pPr><w:pStyle w:val="Heading1"/></w:pPr>'
+            f"<w:r>{_docx_run_text(heading)}</w:r></w:p>"
+            f"<w:p><w:r><w:rPr><w:b/></w:rPr>{album_line}</w:r>"
+            f'<w:hyperlink r:id="{cls.RID}"><w:r><w:rPr><w:color w:val="0000FF"/>'
+            f'<w:u w:val="single"/><w:b/></w:rPr>{_docx_run_text(url)}</w:r>'
+            '</w:hyperlink></w:p>'
+            '<w:p><w:r><w:t>-----</w:t></w:r></w:p>'
+            f"<w:p><w:r>{_docx_run_text(content)}</w:r></w:p>"
+        )
+
+    def add_fragment(self, fragment, url):
+        """Append a page rendered by `render`."""
+        if self.pages > 0:
+            self._body.write('<w:p><w:r><w:br w:type="page"/></w:r></w:p>')
+        self.pages += 1
+
+        r_id = self._relate_to(url)
+        self._body.write(fragment.replace(f'r:id="{self.RID}"', f'r:id="{r_id}"', 1))
+
+    def add_page(self, heading, album_index, url, content):
+        """Append one page: heading, album line, image link and OCR text."""
+        self.add_fragment(self.render(heading, album_index, url, content), url)
+
+    def close(self):
+        """Finish document.xml, write the relationships and close the zip."""
+        import io
+        import shutil
+
+        self._body.write(self._doc_tail)
+        self._body.close()
+
+        self._rels.seek(0)
+        with io.TextIOWrapper(
+            self._zip.open('word/_rels/document.xml.rels', 'w'), encoding='utf-8'
+        ) as rels:
+            rels.write(self._rels_head)
+            shutil.copyfileobj(self._rels, rels)
+            rels.write('</Relationships>')
+        self._rels.close()
+        self._zip.close()
+
+
+class MarkdownWriter:
+    """Write a plaintext megadoc with a YAML-style header on each page."""
+
+    def __init__(self, out_file):
+        self._f = Path(out_file).open('w')
+        self.pages = 0
+
+    extension = 'md'
+
+    @classmethod
+    def render(cls, heading, album_index, url, content):
+        """Render one page: date, album line, image link and OCR text."""
+        return (
+            '---\n'
+            f"date:  {heading}\n"
+            f"album: {album_index}\n"
+            f"image: {url}\n"
+            '---\n'
+            '\n'
+            f"{content}\n"
+        )
+
+    def add_fragment(self, fragment, url):
+        """Append a page rendered by `render`."""
+        if self.pages > 0:
+            self._f.write('\n\n\n')
+        self.pages += 1
+        self._f.write(fragment)
+
+    def add_page(self, heading, album_index, url, content):
+        """Append one page: date, album line, image link and OCR text."""
+        self.add_fragment(self.render(heading, album_index, url, content), url)
+
+    def close(self):
+        self._f.close()
+
+
+def _writer_class(out_file):
+    return DocxWriter if Path(out_file).suffix.lower() == '.docx' else MarkdownWriter
+
+
+def _fragment_file(fragment_path, key, extension):
+    return Path(fragment_path) / key[:2] / f"{key}.{extension}"
+
+
+def load_fragment(fragment_path, key, extension):
+    """Return a cached rendered page, or None."""
+    try:
+        return _fragment_file(fragment_path, key, extension).read_text()
+    except FileNotFoundError:
+        return None
+
+
+def _record_fragments(fragment_path, used):
+    """
+    Record the fragments a build used in the registry of the batch whose
+    cache they're in, for `orca.cache.evict`, and forget them.
+    """
+    from orca.registry import record_fragments
+
+    if used:
+        record_fragments(Path(fragment_path).parent.parent, used)
+        used.clear()
+
+
+def save_fragment(fragment_path, key, extension, fragment):
+    """Cache a rendered page. Safe to call from several processes at once."""
+    import os
+
+    fragment_file = _fragment_file(fragment_path, key, extension)
+    fragment_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = fragment_file.with_name(f".{fragment_file.name}.{os.getpid()}")
+    tmp_file.write_text(fragment)
+    tmp_file.replace(fragment_file)
 
+
+def iter_pages(images, label='', fragment_path=None, extensions=()):
+    """
+    Lay out megadoc pages for a list of images, in timestamp order.
+
+    Yields (n, key, TXT file, heading, album index, URL, content) for each
+    image whose text is found, where n counts every image so far, found or not. The key
+    addresses the page's rendered fragments: it covers the image's UUID, its
+    TXT file's mtime and everything else that goes on the page. If cached
+    fragments exist in `fragment_path` for all of `extensions`, the text isn't
+    read at all and content is None.
+    """
     # We need to load in our base URL in order to make image links.
     # TODO: There's probably a safer way to handle this.
     import os
+    from hashlib import sha1
     from dotenv import load_dotenv
+    from orca.index import is_image_file
 
     load_dotenv()
-
-    out_file = Path(out_file)
-    out_file.parent.mkdir(parents=True, exist_ok=True)
-    out_file_type = out_file.suffix.lower()
-    log.info(
-        'Writing megadoc (%s) from %d documents to %s...'
-        % (out_file_type, len(images), out_file)
-    )
-
-    out_file_ic = out_file.with_stem(f"INCOMPLETE_{out_file.stem}")
+    root_url = os.getenv('ORCA_ROOT_URL', '')
 
     album_sizes = {}
     for i, img in enumerate(sorted(images, key=lambda d: d['timestamp'])):
-        count_str = '[%d/%d] %s' % (i + 1, len(images), out_file)
+        count_str = '[%d/%d] %s' % (i + 1, len(images), label)
         if i == 0 or i % 99 == 0 or i == len(images) - 1:
             log.info(count_str)
         else:
             log.debug(count_str)
 
-        # Find the text file and load its contents.
+        # Find the text file.
         txt_file = Path(img['txt_path'])
-        if not txt_file.exists():
+        try:
+            txt_mtime = txt_file.stat().st_mtime_ns
+        except FileNotFoundError:
             log.warning('File not found: %s' % txt_file)
             continue
-        with txt_file.open() as f:
-            content = f.read()
 
-        # Check album size--we need this to display an iCloud-style heading,
-        # and we probably don't want to query the file system every time.
-        album_size = album_sizes.get(img['album'], None)
-        if not album_size:
-            album_size = len([f for f in Path(img['album_path']).glob('*.*')])
-            album_sizes[img['album']] = album_size
-        album_index = f"{img['album_title']} - {img['index']} of {album_size}"
+        # Album position and size for an iCloud-style heading come from the
+        # index. Images indexed before album stats existed fall back to
+        # counting the album's files, once per album.
+        if 'album_count' in img:
+            album_index = (
+                f"{img['album_title']} - {img['album_position']} of {img['album_count']}"
+            )
+        else:
+            album_size = album_sizes.get(img['album'], None)
+            if not album_size:
+                album_size = len(
+                    [f for f in Path(img['album_path']).glob('*.*') if is_image_file(f)]
+                )
+                album_sizes[img['album']] = album_size
+            album_index = f"{img['album_title']} - {img['index']} of {album_size}"
 
         # Create a link back to the original image.
-        root_url = os.getenv('ORCA_ROOT_URL', '')
         url = f"{root_url}/{img['path']}"
 
-        # Write to Word document--
-        if out_file_type == '.docx':
-            doc = Document(out_file_ic) if out_file_ic.exists() else Document()
-
-            doc.add_heading(img['timestamp_str'], level=1)
-
-            p = doc.add_paragraph()
-            run = p.add_run()
-            run.text = f"{album_index}\n"
-            run.font.bold = True
-
-            # To add a link we need to manipulate the underlying XML directly.
-            run = OxmlElement('w:r')
+        # Only load the text if some format still has to render it.
+        page_hash = sha1(f"{img['timestamp_str']}|{album_index}|{url}".encode('utf-8'))
+        key = f"{img['uuid']}-{txt_mtime}-{page_hash.hexdigest()[:16]}"
+        content = None
+        if not fragment_path or not all(
+            _fragment_file(fragment_path, key, ext).is_file() for ext in extensions
+        ):
+            with txt_file.open() as f:
+                content = f.read()
+
+        yield i + 1, key, txt_file, img['timestamp_str'], album_index, url, content
+
+
+def build_megadocs(images, out_files, fragment_path=None, queue_size=64):
+    """
+    Build megadocs in several formats at once from a single pass over the
+    images. One thread reads and lays out the pages and hands each one to a
+    writer thread per output file, so the text is only read once and the
+    formats are written side by side. With `fragment_path`, rendered pages are
+    cached there and reused by any later megadoc with the same pages.
+
+    Yields (out file, n) as each writer finishes page n, and (out file, None)
+    once that file is complete. Each file is written as INCOMPLETE_<name>
+    and renamed when done.
+    """
+    import queue
+    import threading
+    from time import perf_counter
+    from orca.metrics import inc, observe, span
+
+    out_files = [Path(f) for f in out_files]
+    for out_file in out_files:
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+    log.info(
+        'Writing megadocs (%s) from %d documents...'
+        % (', '.join(f.suffix.lower() for f in out_files), len(images))
+    )
 
-            link = OxmlElement('w:hyperlink')  # Create link
-            link.set(
-                qn('r:id'),
-                doc.part.relate_to(
-                    url,
-                    'http://schemas.openxmlformats.org/officeDocument/2006/relationships/hyperlink',
-                    is_external=True,
-                ),
+    stop = threading.Event()
+    events = queue.Queue()
+    page_queues = [queue.Queue(maxsize=queue_size) for _ in out_files]
+
+    def read():
+        try:
+            label = ', '.join(f.name for f in out_files)
+            extensions = [_writer_class(f).extension for f in out_files]
+            for page in iter_pages(images, label, fragment_path, extensions):
+                if stop.is_set():
+                    break
+                for pages in page_queues:
+                    pages.put(page)
+        except BaseException as e:
+            stop.set()
+            events.put((None, e))
+        finally:
+            for pages in page_queues:
+                pages.put(None)
+
+    def write(out_file, pages):
+        page = ()
+        used = []
+        try:
+            start = perf_counter()
+            render_secs = 0.0
+            pages_written = 0
+            out_file_ic = out_file.with_stem(f"INCOMPLETE_{out_file.stem}")
+            writer = _writer_class(out_file)(out_file_ic)
+            ext = writer.extension
+            filetype = out_file.suffix.lower().lstrip('.')
+            for page in iter(pages.get, None):
+                n, key, txt_file, heading, album_index, url, content = page
+                fragment = None
+                if fragment_path:
+                    fragment = load_fragment(fragment_path, key, ext)
+                if fragment is None:
+                    if content is None:
+                        content = txt_file.read_text()  # Fragment went missing.
+                    render_start = perf_counter()
+                    fragment = writer.render(heading, album_index, url, content)
+                    render_secs += perf_counter() - render_start
+                    if fragment_path:
+                        save_fragment(fragment_path, key, ext, fragment)
+                if fragment_path:
+                    name = _fragment_file('', key, ext).as_posix()
+                    used.append((name, len(fragment.encode('utf-8'))))
+                    if len(used) >= 1000:
+                        _record_fragments(fragment_path, used)
+                writer.add_fragment(fragment, url)
+                pages_written += 1
+                events.put((out_file, n))
+            page = None
+            if stop.is_set():
+                raise RuntimeError('Stopped before all pages were read.')
+            with span('save_megadoc', filetype=filetype):
+                writer.close()
+
+            # Remove .INCOMPLETE suffix.
+            out_file_ic.rename(out_file)
+            elapsed = perf_counter() - start
+            size = out_file.stat().st_size
+            observe('stage_seconds', render_secs, stage='render_pages', filetype=filetype)
+            observe('stage_seconds', elapsed, stage='build_megadoc', filetype=filetype)
+            inc('pages', pages_written, filetype=filetype)
+            inc('bytes_written', size, stage='build_megadoc', filetype=filetype)
+            log.info(
+                'Wrote %d pages (%d bytes) to %s in %.2f seconds (%.1f pages/sec).'
+                % (pages_written, size, out_file, elapsed, pages_written / max(elapsed, 1e-9))
             )
+            events.put((out_file, None))
+        except BaseException as e:
+            stop.set()
+            events.put((out_file, e))
+            while page is not None:
+                page = pages.get()  # Keep the reader from blocking on us.
+        finally:
+            if fragment_path:
+                _record_fragments(fragment_path, used)
+
+    threads = [threading.Thread(target=read, daemon=True)] + [
+        threading.Thread(target=write, args=(f, q), daemon=True)
+        for f, q in zip(out_files, page_queues)
+    ]
+    for thread in threads:
+        thread.start()
+
+    error = None
+    running = len(out_files)
+    try:
+        while running:
+            out_file, n = events.get()
+            if isinstance(n, BaseException):
+                log.error('Error writing megadoc %s: %r' % (out_file, n))
+                error = error or n
+                running -= out_file is not None
+                continue
+            if n is None:
+                running -= 1
+            yield out_file, n
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if error:
+        raise error
+
+
+def build_md(images, out_file, fragment_path=None):
+    """TODO: Description."""
+    for _, n in build_megadocs(images, [out_file], fragment_path):
+        if n is not None:
+            yield n
+
+
+def stream_zip(files):
+    """
+    Yield a zip archive of `files` chunk by chunk as it is written, without
+    staging it anywhere. DOCX files are already compressed, so they are
+    stored as they are; everything else is deflated.
+    """
+    import io
+    from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+    class Sink(io.RawIOBase):
+        # Unseekable, so ZipFile writes data descriptors instead of going
+        # back to patch headers.
+        def __init__(self):
+            self.chunks = []
+
+        def writable(self):
+            return True
+
+        def write(self, b):
+            self.chunks.append(bytes(b))
+            return len(b)
+
+        def drain(self):
+            chunks, self.chunks = self.chunks, []
+            return chunks
+
+    sink = Sink()
+    with ZipFile(sink, 'w') as z:
+        for f in files:
+            f = Path(f)
+            info = ZipInfo.from_file(f, arcname=f.name)
+            is_docx = f.suffix.lower() == '.docx'
+            info.compress_type = ZIP_STORED if is_docx else ZIP_DEFLATED
+            with f.open('rb') as src, z.open(info, 'w') as dest:
+                while chunk := src.read(1024 * 1024):
+                    dest.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+def _build_volume(images, out_files, fragment_path):
+    """Build one volume in every format; run in a worker process."""
+    from orca.metrics import flush
+
+    for _ in build_megadocs(images, out_files, fragment_path):
+        pass
+    flush()  # Worker processes exit without running atexit handlers.
+
+
+def _build_volumes(
+    batch_path,
+    search_info,
+    results,
+    filetypes,
+    volume_size,
+    workers,
+    volumes=None,
+    progress=None,
+):
+    """
+    Split the timestamp-sorted results into volumes of `volume_size` pages
+    and build them across a process pool, recording each volume in its
+    megadoc's progress entry as it completes. Volumes that were already
+    finished by an earlier run (or by another worker) are kept. With
+    `volumes`, only those volume numbers are built.
+    """
+    import os
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from orca.registry import save_megadoc
 
-            rPr = OxmlElement('w:rPr')  # Format
-            color = OxmlElement('w:color')
-            color.set(qn('w:val'), '0000FF')
-            rPr.append(color)
-            underline = OxmlElement('w:u')
-            underline.set(qn('w:val'), 'single')
-            rPr.append(underline)
-            bold = OxmlElement('w:b')
-            rPr.append(bold)
-            run.append(rPr)
-
-            text_tag = OxmlElement('w:t')  # Set text
-            text_tag.text = url
-            run.append(text_tag)
-
-            link.append(run)  # Add to paragraph
-            p._p.append(link)
-            # #####
-
-            doc.add_paragraph('-----')
-            doc.add_paragraph(content)
-
-            if i < len(images) - 1:
-                doc.add_page_break()
-
-            doc.save(out_file_ic)
-            yield i + 1
-
-        # Write to Markdown--
-        else:
-            with out_file_ic.open('a') as f:
-                f.writelines(
-                    [
-                        '---\n',
-                        f"date:  {img['timestamp_str']}\n",
-                        f"album: {album_index}\n",
-                        f"image: {url}\n",
-                        '---\n',
-                        '\n',
-                        f"{content}\n",
-                    ]
-                )
-                if i < len(images) - 1:
-                    f.write('\n\n\n')
-            yield i + 1
+    doc_path = Path(batch_path) / 'cache' / 'megadocs'
+    fragment_path = Path(batch_path) / 'cache' / 'fragments'
+    stem = Path(search_info['results']['json_path']).stem
+    results = sorted(results, key=lambda d: d['timestamp'])
+    chunks = [
+        results[i:i + volume_size] for i in range(0, len(results), volume_size)
+    ]
 
-    # Remove .INCOMPLETE suffix.
-    out_file_ic.rename(out_file)
+    megadocs = {}
+    for filetype in filetypes:
+        megadoc_info = {
+            'filetype': filetype,
+            'path': f"/orca/api/megadocs/{search_info['uuid']}/{filetype}.zip",
+            'pages': 0,
+            'size': 0,
+            'complete': False,
+            'volumes': [],
+        }
+        for i, chunk in enumerate(chunks):
+            vol_file = doc_path / f"{stem}_vol{i + 1:03}.{filetype.lower()}"
+            complete = vol_file.is_file()
+            megadoc_info['volumes'].append(
+                {
+                    'volume': i + 1,
+                    'path': f"{vol_file}",
+                    'pages': len(chunk),
+                    'size': os.path.getsize(vol_file) if complete else 0,
+                    'complete': complete,
+                }
+            )
+        megadocs[filetype] = megadoc_info
+
+    def save(megadoc_info):
+        # Other workers may be building other volumes of the same megadoc.
+        for volume in megadoc_info['volumes']:
+            if not volume['complete'] and os.path.isfile(volume['path']):
+                volume['complete'] = True
+                volume['size'] = os.path.getsize(volume['path'])
+        done = [v for v in megadoc_info['volumes'] if v['complete']]
+        megadoc_info['pages'] = sum(v['pages'] for v in done)
+        megadoc_info['size'] = sum(v['size'] for v in done)
+        megadoc_info['complete'] = len(done) == len(megadoc_info['volumes'])
+        save_megadoc(batch_path, search_info['uuid'], megadoc_info)
+
+    for megadoc_info in megadocs.values():
+        save(megadoc_info)
+
+    todo = {}
+    for i, chunk in enumerate(chunks):
+        if volumes is not None and i + 1 not in volumes:
+            continue
+        out_files = [
+            megadoc_info['volumes'][i]['path']
+            for megadoc_info in megadocs.values()
+            if not megadoc_info['volumes'][i]['complete']
+        ]
+        if out_files:
+            todo[i] = (chunk, out_files)
+    log.info(
+        'Building %d of %d volumes (%s) of up to %d pages...'
+        % (len(todo), len(chunks), ', '.join(filetypes), volume_size)
+    )
 
+    # A single volume is built in this process, which also lets a Celery
+    # worker (whose processes can't have children) build one volume per task.
+    if len(todo) == 1 or workers == 1:
+        for i, (chunk, out_files) in todo.items():
+            _build_volume(chunk, out_files, fragment_path)
+            for filetype, megadoc_info in megadocs.items():
+                save(megadoc_info)
+                if progress:
+                    progress(filetype, megadoc_info['pages'])
+        return
 
-def build_from_search(query_str, batch_path, filetypes=['txt', 'docx']):
-    """TODO: Description."""
-    import json
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(_build_volume, chunk, out_files, fragment_path): i
+            for i, (chunk, out_files) in todo.items()
+        }
+        for future in as_completed(futures):
+            future.result()
+            for filetype, megadoc_info in megadocs.items():
+                volume = megadoc_info['volumes'][futures[future]]
+                volume['complete'] = True
+                volume['size'] = os.path.getsize(volume['path'])
+                save(megadoc_info)
+                if progress:
+                    progress(filetype, megadoc_info['pages'])
+
+
+def build_from_search(
+    query_str,
+    batch_path,
+    filetypes=['txt', 'docx'],
+    volume_size=None,
+    workers=None,
+    volumes=None,
+    progress=None,
+    filters=None,
+):
+    """
+    TODO: Description.
+
+    The search is the one for `query_str` with the same `filters`, if any.
+
+    With `volume_size`, each megadoc is split into volumes of that many pages
+    which are built in parallel by up to `workers` processes, and can be
+    downloaded together as a zip from /orca/api/megadocs. With `volumes`,
+    only those volume numbers are built, so volumes can be shared out between
+    workers.
+
+    `progress`, if given, is called with (filetype, pages done) as pages or
+    volumes are finished.
+    """
+    from orca.metrics import span
+
+    with span('build_from_search'):
+        _build_from_search(
+            query_str,
+            batch_path,
+            filetypes,
+            volume_size,
+            workers,
+            volumes,
+            progress,
+            filters,
+        )
+
+
+def _build_from_search(
+    query_str,
+    batch_path,
+    filetypes,
+    volume_size,
+    workers,
+    volumes,
+    progress,
+    filters,
+    checkpoint_count=500,
+    checkpoint_secs=1.0,
+):
     import os
-    from orca.search import load_search_cache
-
-    search_index, search_index_file = load_search_cache(batch_path)
+    from time import time
+    from orca.cache import evict
+    from orca.registry import save_megadoc
+    from orca.search import find_search, load_results
 
     # Get search results and metadata.
-    search_info = next(s for s in search_index if s['query_str'] == query_str)
-    with Path(search_info['results']['json_path']).open() as f:
-        results = json.load(f)
-
-    if not search_info.get('megadocs'):
-        search_info['megadocs'] = []
-    else:
-        # Remove completed filetypes from queue.
-        for doc in search_info['megadocs']:
-            if doc['complete'] and doc['filetype'] in filetypes:
-                filetypes = [f for f in filetypes if f != doc['filetype']]
+    search_info, _, _ = find_search(query_str, batch_path, filters)
+    if not search_info:
+        log.error('Search not found: "%s"' % query_str)
+        return
+    results = load_results(search_info['results']['json_path'])
+
+    # Remove completed filetypes from queue.
+    for doc in search_info['megadocs']:
+        if doc['complete'] and doc['filetype'] in filetypes:
+            filetypes = [f for f in filetypes if f != doc['filetype']]
 
     if not filetypes or filetypes == []:
         log.info('All megadocs complete or no filetypes specified.')
@@ -162,6 +658,23 @@ def build_from_search(query_str, batch_path, filetypes=['txt', 'docx']):
         doc_path.mkdir(exist_ok=True, parents=True)
     stem = Path(search_info['results']['json_path']).stem
 
+    if volume_size:
+        _build_volumes(
+            batch_path,
+            search_info,
+            results,
+            filetypes,
+            volume_size,
+            workers,
+            volumes,
+            progress,
+        )
+        evict(batch_path)
+        return
+
+    # Every filetype is built from the same pass over the results, each with
+    # its own progress entry.
+    megadocs = {}
     for filetype in filetypes:
         doc_file = doc_path / f"{stem}.{filetype.lower()}"
         megadoc_info = {
@@ -171,17 +684,28 @@ def build_from_search(query_str, batch_path, filetypes=['txt', 'docx']):
             'size': 0,
             'complete': False,
         }
-        search_info['megadocs'].append(megadoc_info)
-        
-        for i in build_md(results, doc_file):
+        save_megadoc(batch_path, search_info['uuid'], megadoc_info)
+        megadocs[doc_file] = megadoc_info
+
+    # Every registry write shows up as a change to the search for everyone
+    # watching it, so page counts only get saved every so often.
+    fragment_path = Path(batch_path) / 'cache' / 'fragments'
+    last_checkpoint = {doc_file: time() for doc_file in megadocs}
+    for doc_file, i in build_megadocs(results, list(megadocs), fragment_path):
+        megadoc_info = megadocs[doc_file]
+        if i is None:
+            megadoc_info['complete'] = True
+            megadoc_info['size'] = os.path.getsize(doc_file)
+        else:
             megadoc_info['pages'] = i
-            with search_index_file.open('w') as f:
-                json.dump(search_index, f)
-        
-        megadoc_info['complete'] = True
-        megadoc_info['size'] = os.path.getsize(doc_file)
-        with search_index_file.open('w') as f:
-                json.dump(search_index, f)
+            if progress:
+                progress(megadoc_info['filetype'], i)
+            if i % checkpoint_count and time() - last_checkpoint[doc_file] <= checkpoint_secs:
+                continue
+        save_megadoc(batch_path, search_info['uuid'], megadoc_info)
+        last_checkpoint[doc_file] = time()
+
+    evict(batch_path)
 
 
 if __name__ == '__main__':
@@ -195,8 +719,22 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('query')
     parser.add_argument('-b', '--batch_path', required=True)
+    parser.add_argument('-v', '--volume_size', type=int)
+    parser.add_argument('-w', '--workers', type=int)
+    parser.add_argument('-a', '--album', action='append')
+    parser.add_argument('--start')
+    parser.add_argument('--end')
+    parser.add_argument('-t', '--tolerant', action='store_true')
     args = parser.parse_args()
 
-    results = build_from_search(args.query, args.batch_path)
+    from orca.search import normalize_filters
+
+    results = build_from_search(
+        args.query,
+        args.batch_path,
+        volume_size=args.volume_size,
+        workers=args.workers,
+        filters=normalize_filters(args.album, args.start, args.end, args.tolerant),
+    )
     log.info('Done!')
 
@@ -0,0 +1,219 @@
+"""
+Timing spans and counters for the hot paths, in the Prometheus text format.
+
+Metrics are off unless ORCA_METRICS_DIR is set, in which case `span`, `inc`
+and `observe` return straight away. When it is set, each process keeps its
+metrics in memory and writes them to its own file in that directory every
+few seconds (and at exit), and `render` adds up every process's file, so the
+web app can serve what the Celery workers measured.
+"""
+
+import logging
+import os
+import threading
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the buckets for `orca_stage_seconds`.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+FLUSH_SECS = 5.0
+
+_dir = os.getenv('ORCA_METRICS_DIR') or None
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_state = {'file': None, 'last_flush': 0.0}
+
+
+def configure(metrics_dir):
+    """Turn metrics on (with a directory) or off (with None) at runtime."""
+    global _dir
+    _dir = f"{metrics_dir}" if metrics_dir else None
+
+
+def enabled():
+    """Return whether metrics are being collected."""
+    return _dir is not None
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, f"{v}") for k, v in labels.items()))
+
+
+def inc(name, n=1, **labels):
+    """Add `n` to the counter `orca_<name>_total`."""
+    if _dir is None:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+    _maybe_flush()
+
+
+def observe(name, value, **labels):
+    """Record a value in the histogram `orca_<name>`."""
+    from bisect import bisect_left
+
+    if _dir is None:
+        return
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            # One count per bucket plus +Inf, then the sum.
+            hist = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        hist[bisect_left(BUCKETS, value)] += 1
+        hist[-1] += value
+    _maybe_flush()
+
+
+class _Span:
+    __slots__ = ('stage', 'labels', 'start')
+
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        from time import perf_counter
+
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        from time import perf_counter
+
+        observe('stage_seconds', perf_counter() - self.start, stage=self.stage, **self.labels)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(stage, **labels):
+    """
+    Return a context manager that times a block and records it in
+    `orca_stage_seconds{stage=...}`.
+    """
+    if _dir is None:
+        return _NO_SPAN
+    return _Span(stage, labels)
+
+
+def _reset():
+    """Forget metrics inherited from a parent process."""
+    global _lock
+    _lock = threading.Lock()
+    _counters.clear()
+    _histograms.clear()
+    _state.update(file=None, last_flush=0.0)
+
+
+os.register_at_fork(after_in_child=_reset)
+
+
+def _maybe_flush():
+    from time import monotonic
+
+    if monotonic() - _state['last_flush'] > FLUSH_SECS:
+        flush()
+
+
+def flush():
+    """Write this process's metrics to its file in the metrics directory."""
+    import atexit
+    import json
+    from time import monotonic
+    from uuid import uuid4
+
+    if _dir is None:
+        return
+    with _lock:
+        _state['last_flush'] = monotonic()
+        data = {
+            'counters': [[n, dict(l), v] for (n, l), v in _counters.items()],
+            'histograms': [[n, dict(l), h] for (n, l), h in _histograms.items()],
+        }
+        if _state['file'] is None:
+            _state['file'] = Path(_dir) / f"{os.getpid()}-{uuid4().hex[:8]}.json"
+            atexit.register(flush)
+        metrics_file = _state['file']
+
+    try:
+        metrics_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = metrics_file.with_suffix('.tmp')
+        with tmp_file.open('w') as f:
+            json.dump(data, f)
+        tmp_file.replace(metrics_file)
+    except OSError as e:
+        log.warning('Error writing metrics to %s: %s' % (metrics_file, e))
+
+
+def _format_labels(labels, **extra):
+    labels = {**dict(labels), **extra}
+    if not labels:
+        return ''
+    escaped = (
+        (k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels.items()
+    )
+    return '{%s}' % ','.join(f'{k}="{v}"' for k, v in escaped)
+
+
+def render():
+    """
+    Return the metrics of every process that has written to the metrics
+    directory, added together, in the Prometheus text format.
+    """
+    import json
+
+    if _dir is None:
+        return ''
+    flush()
+
+    counters = {}
+    histograms = {}
+    for metrics_file in Path(_dir).glob('*.json'):
+        try:
+            with metrics_file.open() as f:
+                data = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            continue
+        for name, labels, value in data['counters']:
+            key = _key(name, labels)
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, hist in data['histograms']:
+            key = _key(name, labels)
+            total = histograms.setdefault(key, [0] * len(hist))
+            for i, value in enumerate(hist):
+                total[i] += value
+
+    lines = []
+    for name in sorted({n for n, _ in counters}):
+        lines.append(f"# TYPE orca_{name}_total counter")
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append(f"orca_{name}_total{_format_labels(labels)} {value}")
+    for name in sorted({n for n, _ in histograms}):
+        lines.append(f"# TYPE orca_{name} histogram")
+        for (n, labels), hist in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, value in zip(BUCKETS + (float('inf'),), hist[:-1]):
+                cumulative += value
+                le = '+Inf' if bound == float('inf') else f"{bound}"
+                lines.append(f"orca_{name}_bucket{_format_labels(labels, le=le)} {cumulative}")
+            lines.append(f"orca_{name}_sum{_format_labels(labels)} {hist[-1]}")
+            lines.append(f"orca_{name}_count{_format_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,431 @@
+"""
+Registry of searches and megadocs for a batch.
+
+Each search and each megadoc is a row in a SQLite database (WAL mode) in the
+batch's cache, so workers can update their own progress without rewriting
+anyone else's, and readers never see a half-written file. Every write bumps a
+revision counter that readers can use to fetch only what changed.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS revision (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    rev INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO revision (id, rev) VALUES (0, 0);
+CREATE TABLE IF NOT EXISTS searches (
+    uuid TEXT PRIMARY KEY,
+    query_str TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    data TEXT NOT NULL,
+    rev INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS searches_query_str ON searches (query_str);
+CREATE INDEX IF NOT EXISTS searches_rev ON searches (rev);
+CREATE TABLE IF NOT EXISTS megadocs (
+    search_uuid TEXT NOT NULL,
+    filetype TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (search_uuid, filetype)
+);
+"""
+
+# Schema changes since the first version, applied in order and tracked with
+# PRAGMA user_version.
+MIGRATIONS = [
+    """
+    ALTER TABLE searches ADD COLUMN cache_key TEXT;
+    ALTER TABLE searches ADD COLUMN last_used REAL;
+    UPDATE searches SET last_used = CAST(strftime('%s', 'now') AS REAL);
+    CREATE INDEX IF NOT EXISTS searches_cache_key ON searches (cache_key);
+    CREATE TABLE IF NOT EXISTS removed (
+        uuid TEXT PRIMARY KEY,
+        rev INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS stats (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS claims (
+        key TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires REAL NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS fragments (
+        name TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS fragments_last_used ON fragments (last_used);
+    """,
+]
+
+# One connection per process, thread and database.
+_local = threading.local()
+
+
+def registry_path(batch_path):
+    """Return the path of the registry database for a batch."""
+    return Path(batch_path) / 'cache' / 'searches' / 'registry.sqlite3'
+
+
+def connect(batch_path):
+    """
+    Return a connection to the registry for a batch, creating it (and
+    migrating search_index.json into it) the first time.
+    """
+    import os
+    import sqlite3
+
+    db_file = registry_path(batch_path)
+    key = (os.getpid(), f"{db_file.resolve()}")
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(key)
+    if conn is not None:
+        return conn
+
+    db_file.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_file, timeout=30.0, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    with _transaction(conn):
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in migration.split(';'):
+                if statement.strip():
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {i}")
+    conns[key] = conn
+
+    migrate_search_index(batch_path, conn)
+    return conn
+
+
+def migrate_search_index(batch_path, conn=None):
+    """
+    Import searches and megadocs from an old search_index.json, then rename
+    it out of the way so the import only ever happens once.
+    """
+    import json
+
+    json_file = Path(batch_path) / 'cache' / 'searches' / 'search_index.json'
+    if not json_file.is_file():
+        return 0
+    conn = conn or connect(batch_path)
+
+    try:
+        with json_file.open() as f:
+            search_index = json.load(f)
+    except json.decoder.JSONDecodeError:
+        log.error('Error loading search index, not migrating: %s' % json_file)
+        return 0
+
+    log.info('Migrating %d searches from %s...' % (len(search_index), json_file))
+    with _transaction(conn):
+        for search_info in search_index:
+            _put_search(conn, search_info)
+            for megadoc_info in search_info.get('megadocs', []):
+                _put_megadoc(conn, search_info['uuid'], megadoc_info)
+    try:
+        json_file.rename(json_file.with_suffix('.json.migrated'))
+    except FileNotFoundError:
+        pass  # Another worker migrated it at the same time.
+    return len(search_index)
+
+
+@contextmanager
+def _transaction(conn):
+    """Run a block in an immediate (write-locked) transaction."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def _bump(conn):
+    conn.execute('UPDATE revision SET rev = rev + 1 WHERE id = 0')
+    return conn.execute('SELECT rev FROM revision WHERE id = 0').fetchone()[0]
+
+
+def _put_search(conn, search_info):
+    import json
+    from time import time
+
+    data = {k: v for k, v in search_info.items() if k != 'megadocs'}
+    conn.execute(
+        'INSERT INTO searches '
+        '(uuid, query_str, timestamp, data, rev, cache_key, last_used) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT (uuid) DO UPDATE SET query_str = excluded.query_str, '
+        'timestamp = excluded.timestamp, data = excluded.data, rev = excluded.rev, '
+        'cache_key = excluded.cache_key',
+        (
+            search_info['uuid'],
+            search_info['query_str'],
+            search_info['timestamp'],
+            json.dumps(data),
+            _bump(conn),
+            search_info.get('cache_key'),
+            time(),
+        ),
+    )
+
+
+def _put_megadoc(conn, search_uuid, megadoc_info):
+    import json
+
+    conn.execute(
+        'INSERT INTO megadocs (search_uuid, filetype, data) VALUES (?, ?, ?) '
+        'ON CONFLICT (search_uuid, filetype) DO UPDATE SET data = excluded.data',
+        (search_uuid, megadoc_info['filetype'], json.dumps(megadoc_info)),
+    )
+    # Megadoc progress shows up as a change to its search.
+    conn.execute(
+        'UPDATE searches SET rev = ? WHERE uuid = ?', (_bump(conn), search_uuid)
+    )
+
+
+def _load(conn, rows):
+    import json
+
+    searches = []
+    for uuid, data in rows:
+        search_info = json.loads(data)
+        search_info['megadocs'] = [
+            json.loads(d)
+            for (d,) in conn.execute(
+                'SELECT data FROM megadocs WHERE search_uuid = ? ORDER BY rowid',
+                (uuid,),
+            )
+        ]
+        searches.append(search_info)
+    return searches
+
+
+def save_search(batch_path, search_info):
+    """Insert or update a search (but not its megadocs)."""
+    conn = connect(batch_path)
+    with _transaction(conn):
+        _put_search(conn, search_info)
+
+
+def save_megadoc(batch_path, search_uuid, megadoc_info):
+    """Insert or update the megadoc of one filetype for a search."""
+    conn = connect(batch_path)
+    with _transaction(conn):
+        _put_megadoc(conn, search_uuid, megadoc_info)
+
+
+def delete_search(batch_path, search_uuid):
+    """Remove a search and its megadocs from the registry."""
+    conn = connect(batch_path)
+    with _transaction(conn):
+        conn.execute('DELETE FROM megadocs WHERE search_uuid = ?', (search_uuid,))
+        conn.execute('DELETE FROM searches WHERE uuid = ?', (search_uuid,))
+        conn.execute(
+            'INSERT OR REPLACE INTO removed (uuid, rev) VALUES (?, ?)',
+            (search_uuid, _bump(conn)),
+        )
+
+
+def touch_search(batch_path, search_uuid):
+    """Mark a search as just used, for LRU eviction."""
+    from time import time
+
+    conn = connect(batch_path)
+    conn.execute(
+        'UPDATE searches SET last_used = ? WHERE uuid = ?', (time(), search_uuid)
+    )
+
+
+def get_search_by_uuid(batch_path, search_uuid):
+    """Return a search by its UUID, or None."""
+    conn = connect(batch_path)
+    rows = conn.execute(
+        'SELECT uuid, data FROM searches WHERE uuid = ?', (search_uuid,)
+    ).fetchall()
+    searches = _load(conn, rows)
+    return searches[0] if searches else None
+
+
+def get_search_by_key(batch_path, cache_key):
+    """Return the most recent search for a cache key, or None."""
+    conn = connect(batch_path)
+    rows = conn.execute(
+        'SELECT uuid, data FROM searches WHERE cache_key = ? '
+        'ORDER BY timestamp DESC LIMIT 1',
+        (cache_key,),
+    ).fetchall()
+    searches = _load(conn, rows)
+    return searches[0] if searches else None
+
+
+def list_searches(batch_path, since=0):
+    """
+    Return the current revision, the searches (with their megadocs) that
+    changed after revision `since`, oldest first, and the UUIDs of searches
+    removed since then.
+    """
+    conn = connect(batch_path)
+    conn.execute('BEGIN')
+    try:
+        rev = conn.execute('SELECT rev FROM revision WHERE id = 0').fetchone()[0]
+        rows = conn.execute(
+            'SELECT uuid, data FROM searches WHERE rev > ? ORDER BY timestamp',
+            (since,),
+        ).fetchall()
+        searches = _load(conn, rows)
+        removed = []
+        if since:
+            removed = [
+                uuid
+                for (uuid,) in conn.execute(
+                    'SELECT uuid FROM removed WHERE rev > ?', (since,)
+                )
+            ]
+    finally:
+        conn.execute('COMMIT')
+    return rev, searches, removed
+
+
+def list_lru(batch_path):
+    """
+    Return all searches (with their megadocs) as (last used, search) pairs,
+    least recently used first.
+    """
+    conn = connect(batch_path)
+    rows = conn.execute(
+        'SELECT uuid, data, last_used FROM searches ORDER BY last_used, timestamp'
+    ).fetchall()
+    searches = _load(conn, [(uuid, data) for uuid, data, _ in rows])
+    return [(last_used, s) for (_, _, last_used), s in zip(rows, searches)]
+
+
+def record_fragments(batch_path, fragments):
+    """
+    Record (name, size) pairs of megadoc page fragments, relative to the
+    batch's fragment cache, as just used.
+    """
+    from time import time
+
+    conn = connect(batch_path)
+    now = time()
+    with _transaction(conn):
+        conn.executemany(
+            'INSERT INTO fragments (name, size, last_used) VALUES (?, ?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET size = excluded.size, '
+            'last_used = excluded.last_used',
+            ((name, size, now) for name, size in fragments),
+        )
+
+
+def fragment_usage(batch_path):
+    """Return the number and total size of the recorded page fragments."""
+    conn = connect(batch_path)
+    n, size = conn.execute('SELECT COUNT(*), SUM(size) FROM fragments').fetchone()
+    return n, size or 0
+
+
+def list_fragments(batch_path, before=None):
+    """
+    Return recorded page fragments as (last used, name, size), least recently
+    used first, only those last used before `before` if it's given.
+    """
+    conn = connect(batch_path)
+    if before is None:
+        return conn.execute(
+            'SELECT last_used, name, size FROM fragments ORDER BY last_used'
+        ).fetchall()
+    return conn.execute(
+        'SELECT last_used, name, size FROM fragments WHERE last_used < ? '
+        'ORDER BY last_used',
+        (before,),
+    ).fetchall()
+
+
+def delete_fragments(batch_path, names):
+    """Forget page fragments that have been removed."""
+    conn = connect(batch_path)
+    with _transaction(conn):
+        conn.executemany('DELETE FROM fragments WHERE name = ?', ((name,) for name in names))
+
+
+def count(batch_path, name, n=1):
+    """Add `n` to one of the registry's counters."""
+    conn = connect(batch_path)
+    conn.execute(
+        'INSERT INTO stats (name, value) VALUES (?, ?) '
+        'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+        (name, n),
+    )
+
+
+def get_stats(batch_path):
+    """Return the registry's counters as a dict."""
+    conn = connect(batch_path)
+    return dict(conn.execute('SELECT name, value FROM stats'))
+
+
+def claim(batch_path, key, owner, ttl=3600.0):
+    """
+    Atomically claim `key` for `owner` for `ttl` seconds, unless someone else
+    holds an unexpired claim on it. Returns whoever holds the claim now.
+    """
+    from time import time
+
+    conn = connect(batch_path)
+    with _transaction(conn):
+        conn.execute(
+            'DELETE FROM claims WHERE key = ? AND expires < ?', (key, time())
+        )
+        conn.execute(
+            'INSERT OR IGNORE INTO claims (key, owner, expires) VALUES (?, ?, ?)',
+            (key, owner, time() + ttl),
+        )
+        return conn.execute(
+            'SELECT owner FROM claims WHERE key = ?', (key,)
+        ).fetchone()[0]
+
+
+def renew_claim(batch_path, key, owner, ttl=3600.0):
+    """
+    Extend a claim for another `ttl` seconds, if `owner` still holds it.
+    Returns whether it did.
+    """
+    from time import time
+
+    conn = connect(batch_path)
+    cursor = conn.execute(
+        'UPDATE claims SET expires = ? WHERE key = ? AND owner = ?',
+        (time() + ttl, key, owner),
+    )
+    return cursor.rowcount > 0
+
+
+def release_claim(batch_path, key, owner):
+    """Release a claim, if `owner` still holds it."""
+    conn = connect(batch_path)
+    conn.execute('DELETE FROM claims WHERE key = ? AND owner = ?', (key, owner))
+
+
+def revision(batch_path):
+    """Return the registry's revision, which changes on every write."""
+    conn = connect(batch_path)
+    return conn.execute('SELECT rev FROM revision WHERE id = 0').fetchone()[0]
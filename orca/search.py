@@ -1,80 +1,272 @@
 """TODO: File description."""
 
 import logging
+import threading
 from pathlib import Path
 
 log = logging.getLogger(__name__)
 
+# Warm indexes and searchers for each batch, see `load_batch`.
+_batches = {}
+_batches_lock = threading.Lock()
 
-def load_search_cache(batch_path):
-    """TODO: Description."""
+
+def load_results(json_path):
+    """
+    Load search results from a results file. New searches are written as JSON
+    Lines, one result per line, and older ones as a single JSON list. A
+    trailing partial line from a search that is still running is ignored.
+    """
     import json
 
-    search_index = []
-    search_index_file = Path(batch_path) / 'cache' / 'searches' / 'search_index.json'
-    if not search_index_file.exists():
-        search_index_file.parent.mkdir(parents=True, exist_ok=True)
-        search_index_file.write_text('[]\n')
-    else:
-        try:
-            with search_index_file.open() as f:
-                search_index = json.load(f)
-        except json.decoder.JSONDecodeError:
-            log.error('Error loading search index: %s ' % search_index)
-            pass
+    json_path = Path(json_path)
+    if json_path.suffix.lower() != '.jsonl':
+        with json_path.open() as f:
+            return json.load(f)
 
-    return search_index, search_index_file
+    results = []
+    with json_path.open() as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            results.append(json.loads(line))
+    return results
 
 
-def whoosh_query(query_str, batch_path):
-    """TODO: Description."""
+def load_batch(batch_path):
+    """
+    Return the parsed image index, a UUID lookup table and an open Whoosh
+    searcher for a batch.
+
+    The image index is memory-mapped from index.bin if there is one, or else
+    parsed from index.json. These are kept warm for the life of the process.
+    The image index and the Whoosh index are reloaded from scratch when the
+    image index changes; otherwise
+    the searcher is refreshed, which only picks up new segments when the Whoosh
+    index has moved on to a new generation. The batch's `generation` changes
+    whenever the content of either index does.
+    """
     import json
-    from time import time
+    from hashlib import sha1
     from whoosh.index import open_dir
     from whoosh.qparser import QueryParser, FuzzyTermPlugin
+    from orca.binindex import BinIndex, current_index_file
+    from orca.metrics import inc, span
 
-    # Load indeces.
-    cache_path = Path(batch_path) / 'cache'
-    index_file = cache_path / 'index.json'
-    with index_file.open() as f:
-        index = json.load(f)
-    whoosh_index_path = cache_path / 'whoosh'
-    whoosh_index = open_dir(whoosh_index_path.as_posix())
-
-    # Parse query and store results.
-    count = 0
-    start = time()
-    with whoosh_index.searcher() as searcher:
-        parser = QueryParser('content', whoosh_index.schema)
-        parser.add_plugin(FuzzyTermPlugin())
-        query = parser.parse(query_str)
-        query_results = searcher.search(query, limit=None)
+    cache_path = Path(batch_path).resolve() / 'cache'
+    index_file = current_index_file(cache_path)
 
-        # Get the UUID of each result and match it against our file index.
-        for result in query_results:
-            yield next(r for r in index['images'] if r['uuid'] == result['uuid'])
-            count += 1
+    with _batches_lock:
+        batch = _batches.get(cache_path)
+        stat = index_file.stat()
+        index_version = (stat.st_mtime_ns, stat.st_size)
 
-    log.info(
-        'Found %d results for "%s" in %d documents. Search took %.2f seconds.'
-        % (count, query_str, len(index['images']), time() - start)
-    )
+        if batch is None or batch['index_version'] != index_version:
+            log.info('Loading index for %s...' % cache_path.parent)
+            inc('index_loads')
+            with span('load_index'):
+                if index_file.suffix == '.bin':
+                    # Records are only decoded as they're looked up.
+                    images = BinIndex(index_file)
+                    index = images.header
+                else:
+                    with index_file.open() as f:
+                        index = json.load(f)
+                    images = {img['uuid']: img for img in index['images']}
+            with span('open_whoosh_index'):
+                whoosh_index = open_dir((cache_path / 'whoosh').as_posix())
+            parser = QueryParser('content', whoosh_index.schema)
+            parser.add_plugin(FuzzyTermPlugin())
+            loaded = {
+                'index_version': index_version,
+                'index': index,
+                'images': images,
+                'whoosh_index': whoosh_index,
+                'searcher': whoosh_index.searcher(),
+                'parser': parser,
+            }
+            if batch is None:
+                batch = _batches[cache_path] = {**loaded, 'lock': threading.Lock()}
+            else:
+                # Searches use the batch (and its searcher) while holding its
+                # lock, so swap everything at once under the lock, keeping the
+                # same dict and lock for any thread that is waiting on it.
+                with batch['lock']:
+                    batch['searcher'].close()
+                    batch.update(loaded)
+        else:
+            searcher = batch['searcher'].refresh()
+            if searcher is not batch['searcher']:
+                with batch['lock']:
+                    batch['searcher'].close()
+                    batch['searcher'] = searcher
 
+        # Generations go by content, so rebuilding an index that hasn't
+        # changed keeps the searches cached against it. Whoosh segments get a
+        # new ID whenever they're written.
+        content_version = batch['index'].get('version', batch['index']['uuid'])
+        segments = ','.join(
+            f"{r.segment().segment_id()}-{r.segment().deleted_count()}"
+            for r, _ in batch['searcher'].reader().leaf_readers()
+        )
+        whoosh_version = sha1(segments.encode('utf-8')).hexdigest()[:16]
+        batch['generation'] = f"{content_version}:{whoosh_version}"
+        return batch
 
-def search(query_str, batch_path):
-    """TODO: Description."""
+
+def _sort_query(query):
+    """Sort the children of AND and OR nodes, bottom up."""
+    from copy import copy
+    from whoosh.query import And, Or
+
+    query = query.apply(_sort_query)
+    if type(query) in (And, Or):
+        query = copy(query)
+        query.subqueries = sorted(query.subqueries, key=repr)
+    return query
+
+
+def normalize_filters(albums=None, start=None, end=None, tolerant=False):
+    """
+    Return album and date filters for a search in a canonical form: a dict
+    with a sorted list of `albums` and ISO `start` and `end` timestamps, with
+    any that aren't set, or are blank as empty form fields are, left out. A
+    date on its own as `end` means the end of that day. Raises ValueError for dates that can't be parsed.
+
+    `tolerant` (see `expand_query`) isn't a filter, but it changes what a
+    query matches, so it's kept with them.
+    """
+    from datetime import datetime, timedelta
+
+    filters = {'tolerant': True} if tolerant else {}
+    if isinstance(albums, str):
+        albums = [albums]
+    albums = {album.strip() for album in albums or []} - {''}
+    if albums:
+        filters['albums'] = sorted(albums)
+    for name, value in (('start', start), ('end', end)):
+        value = f"{value or ''}".strip()
+        if not value:
+            continue
+        ts = datetime.fromisoformat(value)
+        if name == 'end' and len(value) == 10:
+            ts += timedelta(days=1, microseconds=-1)
+        filters[name] = ts.isoformat()
+    if 'start' in filters and 'end' in filters and filters['start'] > filters['end']:
+        raise ValueError('Start date is after end date.')
+    return filters
+
+
+def filter_query(filters):
+    """
+    Return a Whoosh query matching the images allowed by search filters (see
+    `normalize_filters`), or None if there are none.
+    """
+    from datetime import datetime
+    from whoosh.query import And, DateRange, Or, Term
+
+    if not filters:
+        return None
+    parts = []
+    if filters.get('albums'):
+        parts.append(Or([Term('album', album) for album in filters['albums']]))
+    if filters.get('start') or filters.get('end'):
+        start, end = (
+            datetime.fromisoformat(filters[k]) if filters.get(k) else None
+            for k in ('start', 'end')
+        )
+        parts.append(DateRange('timestamp', start, end))
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else And(parts)
+
+
+def _parse(batch, query_str, filters=None):
+    """
+    Parse a query and restrict it to the images allowed by `filters`. The
+    two are intersected in the matcher, so Whoosh skips straight to the
+    documents in both, but the filter doesn't add to the scores.
+    """
+    from whoosh.matching import ConstantScoreWrapperMatcher, NullMatcherClass
+    from whoosh.query import And, WrappingQuery
+
+    # Whoosh's own Require query is meant to do this, but its matcher
+    # excludes the required documents instead (as of 2.7.4).
+    class Restrict(WrappingQuery):
+        def matcher(self, searcher, context=None):
+            m = self.child.matcher(searcher, searcher.boolean_context())
+            if isinstance(m, NullMatcherClass):
+                return m
+            return ConstantScoreWrapperMatcher(m, 0.0)
+
+    query = batch['parser'].parse(query_str)
+    restrict = filter_query(filters)
+    return And([query, Restrict(restrict)]) if restrict else query
+
+
+def canonical_query(query_str, batch_path, filters=None):
+    """
+    Return a canonical form of a query string: parsed by the same parser as
+    searches, normalized, and with AND/OR terms in a fixed order. Queries
+    that differ only in spacing, case or term order come out the same.
+    Filters, if any, are part of the canonical form.
+    """
     import json
+
+    batch = load_batch(batch_path)
+    query = batch['parser'].parse(query_str).normalize()
+    canonical = repr(_sort_query(query))
+    if filters:
+        canonical += f" {json.dumps(filters, sort_keys=True)}"
+    return canonical
+
+
+def _cache_key(query_str, batch_paths, filters=None, sort=None):
+    """
+    Return the key a search is cached under: for a query (and filters)
+    against one batch, or, with a `sort` order, a federated search of
+    `batch_paths`. Queries that mean the same thing get the same key.
+    """
+    import json
+    from hashlib import sha1
+
+    batch_paths = [Path(p) for p in batch_paths]
+    canonical = canonical_query(query_str, batch_paths[0], filters)
+    if sort is not None:
+        batches = sorted(f"{p.resolve()}" for p in batch_paths)
+        canonical = json.dumps(['federated', canonical, batches, sort])
+    return sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def _cached_search(batch_path, key, generation):
+    """
+    Return the search cached under `key` in a batch's registry if it's from
+    this `generation` of the indexes it searched, or None. Cached searches
+    from an older generation are removed.
+    """
+    from orca.cache import remove_search
+    from orca.registry import get_search_by_key
+
+    search_info = get_search_by_key(batch_path, key)
+    if search_info and search_info.get('generation') != generation:
+        log.info('Cached search is out of date: "%s"' % search_info['query_str'])
+        remove_search(batch_path, search_info, reason='invalidations')
+        search_info = None
+    return search_info
+
+
+def _new_search(query_str, batch_path, filters=None):
+    """
+    Return the metadata for a new search, with its results file in the
+    batch's cache named after its time and query.
+    """
     from datetime import datetime
     from uuid import uuid4
     from slugify import slugify
 
-    log.info('Searching for "%s"...' % query_str)
-    batch_path = Path(batch_path)
-
-    # Create new search metadata; overwrite later if the search is cached.
     search_ts = datetime.now().isoformat()
     search_name = f"{'-'.join(slugify(search_ts).split('-')[:-1]).replace('t', '_')}_{slugify(query_str)}"
-    search_file = batch_path / 'cache' / 'searches' / f"{search_name}.json"
+    search_file = Path(batch_path) / 'cache' / 'searches' / f"{search_name}.jsonl"
     search_info = {
         'uuid': f"{uuid4()}",
         'query_str': query_str,
@@ -85,39 +277,627 @@ def search(query_str, batch_path):
             'complete': False,
         },
     }
+    if filters:
+        search_info['filters'] = filters
+    return search_info
+
+
+# How hits are ordered for each sort order of a federated search.
+SORT_KEYS = {'score': lambda h: -h['score'], 'timestamp': lambda h: h['timestamp']}
+
+
+def _sort_key(sort):
+    """Return the key for a federated search's sort order."""
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Unknown sort order: {sort}")
+    return SORT_KEYS[sort]
+
+
+def find_search(query_str, batch_path, filters=None):
+    """
+    Return the cached search for a query (and filters) against the current
+    index, or None. Cached searches from an older generation of the index are
+    removed.
+    """
+    generation = load_batch(batch_path)['generation']
+    key = _cache_key(query_str, [batch_path], filters)
+    return _cached_search(batch_path, key, generation), key, generation
+
+
+def query_limits(time_limit=None, max_hits=None, max_expansions=None, max_postings=None):
+    """
+    Return the limits on a query's cost, filling in any that weren't given
+    from ORCA_QUERY_TIME_LIMIT (seconds, default 30), ORCA_QUERY_MAX_HITS
+    (default none), ORCA_QUERY_MAX_EXPANSIONS (terms per fuzzy, wildcard or
+    prefix term, default 1000) and ORCA_QUERY_MAX_POSTINGS (postings across
+    all of a query's terms, default 5,000,000). 0 means no limit.
+    """
+    import os
+
+    if time_limit is None:
+        time_limit = float(os.getenv('ORCA_QUERY_TIME_LIMIT', 30))
+    if max_hits is None:
+        max_hits = int(os.getenv('ORCA_QUERY_MAX_HITS', 0))
+    if max_expansions is None:
+        max_expansions = int(os.getenv('ORCA_QUERY_MAX_EXPANSIONS', 1000))
+    if max_postings is None:
+        max_postings = int(os.getenv('ORCA_QUERY_MAX_POSTINGS', 5_000_000))
+    return {
+        'time_limit': time_limit or None,
+        'max_hits': max_hits or None,
+        'max_expansions': max_expansions or None,
+        'max_postings': max_postings or None,
+    }
+
+
+def expand_query(
+    query, reader, max_expansions=None, spelling_file=None, max_postings=None, deadline=None
+):
+    """
+    Expand the fuzzy, wildcard and prefix terms in a query into the terms
+    they match in the lexicon, keeping at most `max_expansions` of each, and
+    estimate what the query will cost to run. Returns the expanded query and
+    the cost: the number of terms, how many postings they have, which terms
+    were capped, and whether the query was cut down to `max_postings` or
+    ran past its `deadline` (a `perf_counter` time) while it was expanded.
+
+    Expansions are cut off, keeping the words found so far, once the
+    deadline passes or once their postings, on top of those of the terms
+    that were asked for outright, would go over `max_postings`.
+
+    With a `spelling_file`, the search is tolerant: fuzzy terms are expanded
+    through the spelling index instead of a scan of the lexicon, and so are
+    plain terms, to the words within `orca.spelling.tolerance` edits of them.
+    """
+    from time import perf_counter
+    from whoosh.query import FuzzyTerm, MultiTerm, Term
+    from orca.spelling import candidates, max_distance, tolerance
+
+    class Expansion(MultiTerm):
+        """A fuzzy, wildcard or prefix term, cut down to a fixed set of words."""
+
+        def __init__(self, q, words):
+            self.fieldname = q.field()
+            self.text = q.text
+            self.boost = q.boost
+            self.constantscore = getattr(q, 'constantscore', False)
+            self.words = words
+
+        def __repr__(self):
+            return f"{type(self).__name__}({self.fieldname!r}, {self.text!r}, {len(self.words)} words)"
+
+        def _btexts(self, reader):
+            return self.words
+
+        def has_terms(self):
+            return True
+
+        def terms(self, phrases=False):
+            for word in self.words:
+                yield self.fieldname, word
+
+    capped = []
+    cost = {'over_budget': False, 'timed_out': False}
+
+    def tolerant_words(q):
+        if q.field() != 'content':
+            return None
+        if isinstance(q, FuzzyTerm):
+            k, prefix = q.maxdist, q.prefixlength
+        elif type(q) is Term:
+            k, prefix = tolerance(q.text), 0
+            if not k:
+                return None
+        else:
+            return None
+        if spelling_file.is_file() and k <= max_distance(spelling_file):
+            return (word for word, _, _ in candidates(spelling_file, q.text, k, prefix))
+        # The batch was indexed before there were spelling indexes (or with
+        # one that doesn't go this far), so scan the lexicon instead.
+        return reader.terms_within(q.field(), q.text, k, prefix)
+
+    def expand(q):
+        if cost['timed_out']:
+            return Expansion(q, []) if isinstance(q, MultiTerm) else q
+        words = tolerant_words(q) if spelling_file else None
+        if words is None:
+            if not isinstance(q, MultiTerm) or isinstance(q, Expansion):
+                return q
+            words = q._btexts(reader)
+        expanded = []
+        for word in words:
+            if deadline is not None and perf_counter() > deadline:
+                cost['timed_out'] = True
+                break
+            if max_expansions and len(expanded) >= max_expansions:
+                capped.append(f"{q}")
+                break
+            expanded.append(word)
+        return Expansion(q, expanded)
+
+    query = query.accept(expand)
+
+    # Spend the postings budget on the terms that were asked for outright
+    # first, then on each expansion's words in turn until it runs out.
+    def postings(q):
+        return sum(reader.doc_frequency(f, t) for f, t in q.terms(phrases=True) if f in reader.schema)
+
+    leaves = list(query.leaves())
+    total = sum(postings(q) for q in leaves if not isinstance(q, Expansion))
+    for q in leaves:
+        if not isinstance(q, Expansion):
+            continue
+        for i, word in enumerate(q.words):
+            freq = reader.doc_frequency(q.fieldname, word)
+            if max_postings and total + freq > max_postings:
+                del q.words[i:]
+                cost['over_budget'] = True
+                break
+            total += freq
+
+    terms = [(f, t) for f, t in query.iter_all_terms() if f in reader.schema]
+    cost.update(terms=len(terms), postings=total, capped=capped)
+    return query, cost
+
+
+def _spelling_file(batch_path, filters):
+    """Return the spelling index to expand a query through, if it's tolerant."""
+    from orca.spelling import spelling_path
+
+    if not (filters or {}).get('tolerant'):
+        return None
+    return spelling_path(Path(batch_path).resolve())
+
+
+def _deadline(limits):
+    """Return the `perf_counter` time a query started now has to finish by."""
+    from time import perf_counter
+
+    if not limits['time_limit']:
+        return None
+    return perf_counter() + limits['time_limit']
+
 
-    # Check the cache--have we done this search before?
-    search_index, search_index_file = load_search_cache(batch_path)
-    for search in search_index:
-        if query_str == search['query_str']:
-            search_info.update(search)
-            search_file = Path(search_info['results']['json_path'])
-            is_complete = search_info['results']['complete']
-            if search_file.exists() or search_file.is_file() and is_complete:
-                with search_file.open() as f:
-                    results = json.load(f)
-            return results, search_info
-    
-    # If not, start a new search.
+def _expand(searcher, query, limits, spelling_file, deadline):
+    """Expand a query within `limits` (see `expand_query`) and log its cost."""
+    query, cost = expand_query(
+        query,
+        searcher.reader(),
+        limits['max_expansions'],
+        spelling_file,
+        limits['max_postings'],
+        deadline,
+    )
+    log.info('Query "%s" has %d terms with %d postings.' % (query, cost['terms'], cost['postings']))
+    if cost['capped']:
+        log.warning('Capped term expansions: %s' % ', '.join(cost['capped']))
+    if cost['over_budget']:
+        log.warning('Cut term expansions down to %d postings.' % limits['max_postings'])
+    return query, cost
+
+
+def _run_query(searcher, query, limits, terms=False, limit=None, deadline=None, sortedby=None):
+    """
+    Run a query within `limits`, collecting at most `limit` (or max_hits)
+    hits, best first or by `sortedby`, and finishing by `deadline` if one is
+    given instead of within the whole time limit. Returns the results, which
+    are partial if the time ran out, and whether it did.
+    """
+    from time import perf_counter
+    from whoosh.collectors import TimeLimit, TimeLimitCollector
+
+    max_hits = limits['max_hits']
+    if limit is None or (max_hits and limit > max_hits):
+        limit = max_hits
+    collector = searcher.collector(limit=limit, sortedby=sortedby, terms=terms)
+    time_limit = limits['time_limit']
+    if deadline is not None:
+        time_limit = max(deadline - perf_counter(), 0.001)
+    if time_limit:
+        # No SIGALRM: searches run in worker and web server threads.
+        collector = TimeLimitCollector(collector, time_limit, use_alarm=False)
+    try:
+        searcher.search_with_collector(query, collector)
+    except TimeLimit:
+        return collector.results(), True
+    return collector.results(), False
+
+
+def _truncation(query_results, cost, limits, timed_out):
+    """Return why a query's results are incomplete, if they are."""
+    reasons = []
+    if timed_out or cost['timed_out']:
+        reasons.append('time_limit')
+    max_hits = limits['max_hits']
+    if max_hits and query_results.scored_length() >= max_hits:
+        if query_results.estimated_length() > max_hits:
+            reasons.append('max_hits')
+    if cost['capped']:
+        reasons.append('max_expansions')
+    if cost['over_budget']:
+        reasons.append('max_postings')
+    return reasons
+
+
+def whoosh_query(
+    query_str,
+    batch_path,
+    filters=None,
+    info=None,
+    time_limit=None,
+    max_hits=None,
+    max_expansions=None,
+    max_postings=None,
+):
+    """
+    Yield the image for each hit on a query, best first. The query's cost
+    is limited by `query_limits`; if `info` is a dict, it's filled in with
+    the cost and whether (and why) the results were truncated.
+    """
+    from time import perf_counter, time
+    from orca.metrics import inc, observe, span
+
+    # Load indeces.
+    batch = load_batch(batch_path)
+    limits = query_limits(time_limit, max_hits, max_expansions, max_postings)
+
+    # Parse and run the query, and read the UUID of every hit while the
+    # searcher can't be swapped out from under us.
+    count = 0
+    start = time()
+    with batch['lock']:
+        images = batch['images']
+        searcher = batch['searcher']
+        deadline = _deadline(limits)
+        with span('parse_query'):
+            query = _parse(batch, query_str, filters)
+            query, cost = _expand(
+                searcher, query, limits, _spelling_file(batch_path, filters), deadline
+            )
+        with span('whoosh_search'):
+            query_results, timed_out = _run_query(searcher, query, limits, deadline=deadline)
+            reasons = _truncation(query_results, cost, limits, timed_out)
+            uuids = [hit['uuid'] for hit in query_results]
+
+    for reason in reasons:
+        inc('queries_truncated', reason=reason)
+    if reasons:
+        log.warning('Results for "%s" truncated by: %s' % (query_str, ', '.join(reasons)))
+    if info is not None:
+        info.update(cost=cost, truncated=bool(reasons), truncated_by=reasons)
+
+    # Get the UUID of each result and match it against our file index. Only
+    # time the lookups, not whatever the caller does with each image.
+    resolve_secs = 0.0
+    for uuid in uuids:
+        resolve_start = perf_counter()
+        img = images.get(uuid)
+        resolve_secs += perf_counter() - resolve_start
+        if img is None:
+            log.warning('Result not in index, skipping: %s' % uuid)
+            continue
+        yield img
+        count += 1
+
+    observe('stage_seconds', resolve_secs, stage='resolve_hits')
+    inc('results', count)
+    log.info(
+        'Found %d results for "%s" in %d documents. Search took %.2f seconds.'
+        % (count, query_str, len(images), time() - start)
+    )
+
+
+def search_page(query_str, batch_path, offset=0, limit=20, filters=None):
+    """
+    Return one page of ranked results for a query, with scores, image metadata
+    and highlighted fragments of the OCR text, straight from the warm searcher.
+    Only the top `offset + limit` hits get scored and sorted, the same as
+    Whoosh's `search_page`, but the page can start at any offset. The query's
+    cost is limited the same way as in `whoosh_query`.
+    """
+    from time import time
+
+    batch = load_batch(batch_path)
+    limits = query_limits()
+    start = time()
+    with batch['lock']:
+        searcher = batch['searcher']
+        deadline = _deadline(limits)
+        query = _parse(batch, query_str, filters)
+        query, cost = _expand(searcher, query, limits, _spelling_file(batch_path, filters), deadline)
+        query_results, timed_out = _run_query(
+            searcher, query, limits, terms=True, limit=offset + limit, deadline=deadline
+        )
+        reasons = _truncation(query_results, cost, limits, timed_out)
+
+        results = []
+        for hit in query_results[offset:offset + limit]:
+            img = batch['images'].get(hit['uuid'])
+            if img is None:
+                log.warning('Result not in index, skipping: %s' % hit['uuid'])
+                continue
+            results.append(
+                {
+                    **img,
+                    'rank': hit.rank + 1,
+                    'score': hit.score,
+                    'highlights': hit.highlights('content', top=3),
+                }
+            )
+        # Counting every hit means running the query again, so don't bother
+        # once it has already run out of time.
+        total = query_results.scored_length() if timed_out else len(query_results)
+
+    log.info(
+        'Page %d-%d of %d results for "%s" took %.3f seconds.'
+        % (offset + 1, offset + len(results), total, query_str, time() - start)
+    )
+    return {
+        'query_str': query_str,
+        'filters': filters or {},
+        'offset': offset,
+        'limit': limit,
+        'total': total,
+        'truncated': bool(reasons),
+        'truncated_by': reasons,
+        'cost': cost,
+        'results': results,
+    }
+
+
+def search(
+    query_str, batch_path, checkpoint_count=500, checkpoint_secs=1.0, filters=None
+):
+    """TODO: Description."""
+    import json
+    from time import perf_counter, time
+    from orca.cache import evict
+    from orca.metrics import inc, observe, span
+    from orca.registry import count, save_search, touch_search
+
+    log.info('Searching for "%s"...' % query_str)
+    batch_path = Path(batch_path)
+
+    # Create new search metadata; overwrite later if the search is cached.
+    search_info = _new_search(query_str, batch_path, filters)
+
+    # Check the cache--have we done this search (or one that means the same
+    # thing) against this version of the index before?
+    cached, cache_key, generation = find_search(query_str, batch_path, filters)
+    search_info['cache_key'] = cache_key
+    search_info['generation'] = generation
+    if cached:
+        count(batch_path, 'hits')
+        inc('search_cache', result='hit')
+        touch_search(batch_path, cached['uuid'])
+        search_info = cached
+        search_file = Path(search_info['results']['json_path'])
+        is_complete = search_info['results']['complete']
+        results = []
+        if search_file.is_file():
+            results = load_results(search_file)
+        elif is_complete:
+            log.warning('Results file not found: %s' % search_file)
+        return results, search_info
+
+    # If not, start a new search. Results are appended to the file as they
+    # come in; progress in the registry only gets updated every so often.
+    count(batch_path, 'misses')
+    inc('search_cache', result='miss')
     results = []
-    search_index.append(search_info)
+    save_search(batch_path, search_info)
     search_file = Path(search_info['results']['json_path'])
-    for result in whoosh_query(query_str, batch_path):
-        results.append(result)
-        search_info['results']['count'] = len(results)
-        with search_index_file.open('w') as f:
-            json.dump(search_index, f)
-        with search_file.open('w') as f:
-            json.dump(results, f)
+    with span('search'), search_file.open('w') as f:
+        last_checkpoint = time()
+        write_secs = 0.0
+        query_info = {}
+        for result in whoosh_query(query_str, batch_path, filters, info=query_info):
+            results.append(result)
+            write_start = perf_counter()
+            f.write(f"{json.dumps(result)}\n")
+            write_secs += perf_counter() - write_start
 
+            found = len(results)
+            if found % checkpoint_count == 0 or time() - last_checkpoint > checkpoint_secs:
+                f.flush()
+                search_info['results']['count'] = found
+                save_search(batch_path, search_info)
+                last_checkpoint = time()
+        observe('stage_seconds', write_secs, stage='write_results')
+        inc('bytes_written', f.tell(), stage='write_results')
+
+    search_info['results']['count'] = len(results)
     search_info['results']['complete'] = True
-    with search_index_file.open('w') as f:
-            json.dump(search_index, f)
+    search_info['results']['truncated'] = query_info['truncated']
+    search_info['results']['truncated_by'] = query_info['truncated_by']
+    if query_info['truncated']:
+        # Where a truncated search stops depends on the limits at the time
+        # (and on the load), so don't reuse it.
+        search_info['cache_key'] = None
+    save_search(batch_path, search_info)
+    evict(batch_path)
+    return results, search_info
+
+
+def _search_batch(query_str, batch_path, filters, sort, limits, limit=None):
+    """
+    Run a query against one batch of a federated search and return its hits,
+    the first `limit` of them if given, in `sort` order, each with its batch
+    and score, and stats for the batch: its hit count, the time it took and
+    why its hits were truncated, if they were.
+    """
+    from time import perf_counter
+    from orca.metrics import span
+
+    start = perf_counter()
+    batch = load_batch(batch_path)
+    hits = []
+    with span('search_batch'), batch['lock']:
+        images = batch['images']
+        name = batch['index']['batch']
+        generation = batch['generation']
+        searcher = batch['searcher']
+        deadline = _deadline(limits)
+        query = _parse(batch, query_str, filters)
+        query, cost = _expand(searcher, query, limits, _spelling_file(batch_path, filters), deadline)
+        query_results, timed_out = _run_query(
+            searcher,
+            query,
+            limits,
+            limit=limit,
+            deadline=deadline,
+            sortedby='timestamp' if sort == 'timestamp' else None,
+        )
+        reasons = _truncation(query_results, cost, limits, timed_out)
+        for hit in query_results:
+            img = images.get(hit['uuid'])
+            if img is None:
+                log.warning('Result not in index, skipping: %s' % hit['uuid'])
+                continue
+            hits.append({**img, 'batch': name, 'score': hit.score})
+        total = query_results.scored_length() if timed_out else len(query_results)
+
+    stats = {
+        'batch_path': f"{batch_path}",
+        'batch': name,
+        'generation': generation,
+        'count': len(hits),
+        'total': total,
+        'seconds': perf_counter() - start,
+        'truncated_by': reasons,
+    }
+    log.info(
+        'Found %d results for "%s" in %s in %.2f seconds.'
+        % (len(hits), query_str, name, stats['seconds'])
+    )
+    return hits, stats
+
+
+def federated_search(query_str, batch_paths, filters=None, sort='score', workers=None):
+    """
+    Search several batches at once, each in its own thread with its own warm
+    searcher, and merge their hits into one list, best first (`sort='score'`)
+    or oldest first (`sort='timestamp'`). Scores come from each batch's own
+    index, so they're only roughly comparable between batches.
+
+    The search is saved in the registry of the first batch, with the count
+    and time of each batch in `search_info['batches']`, and cached there
+    until any of the batches' indexes change.
+    """
+    import heapq
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+    from orca.cache import evict
+    from orca.metrics import inc, span
+    from orca.registry import count, save_search, touch_search
+
+    sort_key = _sort_key(sort)
+    batch_paths = [Path(p) for p in batch_paths]
+    home_path = batch_paths[0]
+    log.info('Searching %d batches for "%s"...' % (len(batch_paths), query_str))
+
+    # Check the cache, as `search` does, against every batch's index.
+    key = _cache_key(query_str, batch_paths, filters, sort)
+    generation = ';'.join(load_batch(p)['generation'] for p in batch_paths)
+    cached = _cached_search(home_path, key, generation)
+    if cached and Path(cached['results']['json_path']).is_file():
+        count(home_path, 'hits')
+        inc('search_cache', result='hit')
+        touch_search(home_path, cached['uuid'])
+        return load_results(cached['results']['json_path']), cached
+
+    count(home_path, 'misses')
+    inc('search_cache', result='miss')
+    search_info = _new_search(query_str, home_path, filters)
+    search_info.update(sort=sort, cache_key=key, generation=generation)
+    search_file = Path(search_info['results']['json_path'])
+    save_search(home_path, search_info)
+
+    limits = query_limits()
+    with span('federated_search'):
+        with ThreadPoolExecutor(workers or len(batch_paths)) as executor:
+            futures = [
+                executor.submit(_search_batch, query_str, p, filters, sort, limits)
+                for p in batch_paths
+            ]
+            done = [future.result() for future in futures]
+
+        results = list(heapq.merge(*(hits for hits, _ in done), key=sort_key))
+        reasons = {r for _, stats in done for r in stats['truncated_by']}
+        if limits['max_hits'] and len(results) > limits['max_hits']:
+            del results[limits['max_hits']:]
+            reasons.add('max_hits')
+        search_file.parent.mkdir(parents=True, exist_ok=True)
+        with search_file.open('w') as f:
+            for result in results:
+                f.write(f"{json.dumps(result)}\n")
+
+    search_info['batches'] = [stats for _, stats in done]
+    reasons = sorted(reasons)
+    search_info['results'].update(
+        count=len(results), complete=True, truncated=bool(reasons), truncated_by=reasons
+    )
+    if reasons:
+        search_info['cache_key'] = None
+    save_search(home_path, search_info)
+    evict(home_path)
+    log.info(
+        'Found %d results for "%s" in %d batches.' % (len(results), query_str, len(batch_paths))
+    )
     return results, search_info
 
 
+def federated_page(
+    query_str, batch_paths, offset=0, limit=20, filters=None, sort='score', workers=None
+):
+    """
+    Return one page of the merged results of a federated search, straight
+    from the batches' warm searchers. Each batch only collects its own first
+    `offset + limit` hits, the most any page this deep could need from it,
+    the same as `search_page`. Pages aren't saved or cached.
+    """
+    import heapq
+    from concurrent.futures import ThreadPoolExecutor
+    from time import time
+
+    sort_key = _sort_key(sort)
+    batch_paths = [Path(p) for p in batch_paths]
+    limits = query_limits()
+    start = time()
+    with ThreadPoolExecutor(workers or len(batch_paths)) as executor:
+        futures = [
+            executor.submit(_search_batch, query_str, p, filters, sort, limits, offset + limit)
+            for p in batch_paths
+        ]
+        done = [future.result() for future in futures]
+
+    results = list(heapq.merge(*(hits for hits, _ in done), key=sort_key))
+    total = sum(stats['total'] for _, stats in done)
+    if limits['max_hits']:
+        total = min(total, limits['max_hits'])
+    reasons = sorted({r for _, stats in done for r in stats['truncated_by']})
+    results = results[offset:offset + limit]
+    log.info(
+        'Page %d-%d of %d results for "%s" in %d batches took %.3f seconds.'
+        % (offset + 1, offset + len(results), total, query_str, len(batch_paths), time() - start)
+    )
+    return {
+        'query_str': query_str,
+        'filters': filters or {},
+        'sort': sort,
+        'offset': offset,
+        'limit': limit,
+        'total': total,
+        'truncated': bool(reasons),
+        'truncated_by': reasons,
+        'batches': [stats for _, stats in done],
+        'results': results,
+    }
+
+
 if __name__ == '__main__':
     import argparse
+    import os
 
     logging.basicConfig(
         level=logging.INFO,
@@ -126,8 +906,24 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('query')
-    parser.add_argument('-b', '--batch_path', required=True)
+    parser.add_argument('-b', '--batch_path', nargs='+', required=True)
+    parser.add_argument('-a', '--album', action='append')
+    parser.add_argument('--start')
+    parser.add_argument('--end')
+    parser.add_argument('-t', '--tolerant', action='store_true')
+    parser.add_argument('-s', '--sort', choices=['score', 'timestamp'], default='score')
+    parser.add_argument('--time_limit', type=float)
+    parser.add_argument('--max_hits', type=int)
+    parser.add_argument('--max_expansions', type=int)
+    parser.add_argument('--max_postings', type=int)
     args = parser.parse_args()
 
-    results = search(args.query, args.batch_path)
+    for name in ('time_limit', 'max_hits', 'max_expansions', 'max_postings'):
+        if getattr(args, name) is not None:
+            os.environ[f"ORCA_QUERY_{name.upper()}"] = f"{getattr(args, name)}"
+    filters = normalize_filters(args.album, args.start, args.end, args.tolerant)
+    if len(args.batch_path) > 1:
+        results, _ = federated_search(args.query, args.batch_path, filters, args.sort)
+    else:
+        results, _ = search(args.query, args.batch_path[0], filters=filters)
     log.info('Done!')
@@ -0,0 +1,312 @@
+"""
+Spelling index for OCR-error-tolerant search.
+
+A SymSpell-style deletion index over the words in the Whoosh index's `content`
+lexicon. Each word is filed under every string that's left after deleting up
+to `max_distance` characters from its first `prefix_length` characters. A
+misspelled word then finds its candidate corrections by looking up its own
+deletions, instead of working out its edit distance to every word in the
+lexicon the way Whoosh's `FuzzyTerm` does, and only those few candidates get
+their distance checked.
+
+The index is a SQLite database in the batch's cache, next to the Whoosh index.
+It's built once and then updated with only the words that come and go from the
+lexicon as the Whoosh index changes.
+"""
+
+import logging
+import threading
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+MAX_DISTANCE = 2
+PREFIX_LENGTH = 7
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS words (
+    id INTEGER PRIMARY KEY,
+    word TEXT NOT NULL UNIQUE,
+    freq INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deletes (
+    variant TEXT NOT NULL,
+    word_id INTEGER NOT NULL,
+    PRIMARY KEY (variant, word_id)
+) WITHOUT ROWID;
+"""
+
+# One read connection per process, thread and version of the index.
+_local = threading.local()
+
+# Words inserted per statement when building an index.
+CHUNK_SIZE = 10_000
+
+
+def spelling_path(batch_path):
+    """Return the path of the spelling index for a batch."""
+    return Path(batch_path) / 'cache' / 'spelling.sqlite3'
+
+
+def deletes(word, max_distance):
+    """
+    Return `word` and every string left after deleting up to `max_distance`
+    characters from it.
+    """
+    variants = {word}
+    edge = {word}
+    for _ in range(max_distance):
+        edge = {w[:i] + w[i + 1:] for w in edge for i in range(len(w))}
+        edge -= variants
+        variants |= edge
+    return variants
+
+
+def _add_words(conn, words, max_distance, prefix_length):
+    """
+    Insert (id, word, frequency) rows into a spelling index, with their
+    deletions, and return the number of deletions.
+    """
+    conn.executemany('INSERT INTO words (id, word, freq) VALUES (?, ?, ?)', words)
+    rows = [
+        (variant, word_id)
+        for word_id, word, _ in words
+        for variant in deletes(word[:prefix_length], max_distance)
+    ]
+    conn.executemany('INSERT INTO deletes (variant, word_id) VALUES (?, ?)', rows)
+    return len(rows)
+
+
+def build_spelling_index(
+    reader, db_file, fieldname='content', max_distance=MAX_DISTANCE, prefix_length=PREFIX_LENGTH
+):
+    """
+    Build the spelling index for the words in a field of a Whoosh index,
+    replacing any old one, and return the number of words in it.
+    """
+    import sqlite3
+    from time import perf_counter
+
+    db_file = Path(db_file)
+    tmp_file = db_file.with_name(f".{db_file.name}.tmp")
+    tmp_file.unlink(missing_ok=True)
+    start = perf_counter()
+
+    conn = sqlite3.connect(tmp_file, isolation_level=None)
+    try:
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.executescript(SCHEMA)
+        conn.execute('BEGIN')
+        conn.executemany(
+            'INSERT INTO meta (key, value) VALUES (?, ?)',
+            [
+                ('fieldname', fieldname),
+                ('max_distance', f"{max_distance}"),
+                ('prefix_length', f"{prefix_length}"),
+            ],
+        )
+        count = 0
+        variant_count = 0
+        words = []
+        for word_id, (btext, terminfo) in enumerate(reader.iter_field(fieldname), start=1):
+            words.append((word_id, btext.decode('utf-8'), terminfo.doc_frequency()))
+            if len(words) >= CHUNK_SIZE:
+                variant_count += _add_words(conn, words, max_distance, prefix_length)
+                count += len(words)
+                words = []
+        variant_count += _add_words(conn, words, max_distance, prefix_length)
+        count += len(words)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    tmp_file.replace(db_file)
+
+    log.info(
+        'Built spelling index of %d words (%d deletions) in %.2f seconds: %s'
+        % (count, variant_count, perf_counter() - start, db_file)
+    )
+    return count
+
+
+def update_spelling_index(reader, db_file, fieldname='content'):
+    """
+    Bring the spelling index up to date with the words in a field of a Whoosh
+    index, adding and removing only the words that changed, and return the
+    number of words added, removed and with a new frequency. Builds the index
+    from scratch if there isn't one yet for the field.
+    """
+    import sqlite3
+    from time import perf_counter
+
+    db_file = Path(db_file)
+    start = perf_counter()
+    conn = None
+    if db_file.is_file():
+        conn = sqlite3.connect(db_file, isolation_level=None)
+        meta = dict(conn.execute('SELECT key, value FROM meta'))
+        if meta.get('fieldname') != fieldname:
+            conn.close()
+            conn = None
+    if conn is None:
+        count = build_spelling_index(reader, db_file, fieldname)
+        return {'added': count, 'removed': 0, 'changed': 0}
+
+    try:
+        max_distance = int(meta['max_distance'])
+        prefix_length = int(meta['prefix_length'])
+        old = {
+            word: (word_id, freq)
+            for word_id, word, freq in conn.execute('SELECT id, word, freq FROM words')
+        }
+        new = {
+            btext.decode('utf-8'): terminfo.doc_frequency()
+            for btext, terminfo in reader.iter_field(fieldname)
+        }
+        removed = old.keys() - new.keys()
+        next_id = max((word_id for word_id, _ in old.values()), default=0) + 1
+        added = [
+            (word_id, word, new[word])
+            for word_id, word in enumerate(sorted(new.keys() - old.keys()), start=next_id)
+        ]
+        changed = [
+            (freq, old[word][0])
+            for word, freq in new.items()
+            if word in old and old[word][1] != freq
+        ]
+
+        # A removed word's deletions can be worked out again from the word,
+        # so they're deleted by primary key rather than by scanning for its ID.
+        conn.execute('BEGIN')
+        conn.executemany(
+            'DELETE FROM deletes WHERE variant = ? AND word_id = ?',
+            (
+                (variant, old[word][0])
+                for word in removed
+                for variant in deletes(word[:prefix_length], max_distance)
+            ),
+        )
+        conn.executemany('DELETE FROM words WHERE id = ?', ((old[word][0],) for word in removed))
+        conn.executemany('UPDATE words SET freq = ? WHERE id = ?', changed)
+        _add_words(conn, added, max_distance, prefix_length)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+    log.info(
+        'Updated spelling index in %.2f seconds: %d words added, %d removed, %d changed: %s'
+        % (perf_counter() - start, len(added), len(removed), len(changed), db_file)
+    )
+    return {'added': len(added), 'removed': len(removed), 'changed': len(changed)}
+
+
+def _connect(db_file):
+    """Return a read-only connection to a spelling index, and its settings."""
+    import os
+    import sqlite3
+
+    db_file = Path(db_file)
+    stat = db_file.stat()
+    key = (os.getpid(), f"{db_file.resolve()}")
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+
+    # The index is replaced when it's rebuilt and changed in place when it's
+    # updated, so reconnect if either has happened.
+    version = (stat.st_ino, stat.st_mtime_ns)
+    cached = conns.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1], cached[2]
+    if cached is not None:
+        cached[1].close()
+
+    conn = sqlite3.connect(f"{db_file.resolve().as_uri()}?mode=ro", uri=True)
+    meta = dict(conn.execute('SELECT key, value FROM meta'))
+    meta['max_distance'] = int(meta['max_distance'])
+    meta['prefix_length'] = int(meta['prefix_length'])
+    conns[key] = (version, conn, meta)
+    return conn, meta
+
+
+def max_distance(db_file):
+    """Return the largest edit distance a spelling index can look up."""
+    return _connect(db_file)[1]['max_distance']
+
+
+def candidates(db_file, word, max_distance=1, prefix=0):
+    """
+    Return the words in a spelling index within `max_distance` Levenshtein
+    edits of `word` (and sharing its first `prefix` characters), the same
+    words Whoosh's `FuzzyTerm` would match, as (word, distance, frequency)
+    tuples, closest and then most common first.
+    """
+    from whoosh.support.levenshtein import levenshtein
+
+    conn, meta = _connect(db_file)
+    if max_distance > meta['max_distance']:
+        raise ValueError(
+            f"Spelling index only goes up to distance {meta['max_distance']}: {db_file}"
+        )
+
+    variants = list(deletes(word[:meta['prefix_length']], max_distance))
+    rows = conn.execute(
+        'SELECT DISTINCT words.word, words.freq FROM deletes '
+        'JOIN words ON words.id = deletes.word_id '
+        f"WHERE deletes.variant IN ({', '.join('?' * len(variants))})",
+        variants,
+    ).fetchall()
+
+    results = []
+    for candidate, freq in rows:
+        if prefix and candidate[:prefix] != word[:prefix]:
+            continue
+        if abs(len(candidate) - len(word)) > max_distance:
+            continue
+        k = levenshtein(word, candidate, limit=max_distance)
+        if k <= max_distance:
+            results.append((candidate, k, freq))
+    results.sort(key=lambda r: (r[1], -r[2], r[0]))
+    return results
+
+
+def tolerance(word, max_distance=MAX_DISTANCE):
+    """
+    Return how many edits tolerant searches allow for a word: none for words
+    of up to three characters, which would match half the lexicon, one for
+    words of up to seven, and two (or `max_distance`) for anything longer.
+    """
+    return min(max_distance, len(word) // 4)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+    )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('batch_path')
+    parser.add_argument('word', nargs='?')
+    parser.add_argument('-d', '--max_distance', type=int, default=MAX_DISTANCE)
+    parser.add_argument('-p', '--prefix_length', type=int, default=PREFIX_LENGTH)
+    args = parser.parse_args()
+
+    # Look a word up, or (re)build the spelling index for a batch.
+    db_file = spelling_path(args.batch_path)
+    if args.word:
+        for candidate, k, freq in candidates(db_file, args.word, args.max_distance):
+            log.info('%s (distance %d, %d documents)' % (candidate, k, freq))
+    else:
+        from whoosh.index import open_dir
+
+        whoosh_index = open_dir((Path(args.batch_path) / 'cache' / 'whoosh').as_posix())
+        with whoosh_index.reader() as reader:
+            build_spelling_index(reader, db_file, 'content', args.max_distance, args.prefix_length)
+    log.info('Done!')
@@ -8,10 +8,12 @@ from uuid import uuid4
 from celery import Celery
 from flask import (
     Flask,
+    Response,
     jsonify,
     redirect,
     render_template,
     request,
+    stream_with_context,
     url_for,
 )
 
@@ -24,49 +26,515 @@ celery = Celery(
     backend=os.getenv('ORCA_BACKEND_URL', 'redis://localhost:6379/0'),
 )
 celery.conf.update(app.config)
+celery.conf.update(
+    # Searches are quick and megadocs can take hours, so they run on separate
+    # queues with their own workers and concurrency, e.g.
+    #   celery -A wsgi.celery worker -Q searches -c 8
+    #   celery -A wsgi.celery worker -Q megadocs -c 2
+    task_routes={
+        'wsgi.do_search': {'queue': 'searches'},
+        'wsgi.finish_search': {'queue': 'searches'},
+        'wsgi.build_megadoc': {'queue': 'megadocs'},
+    },
+    # With Redis, priority 0 goes first and 9 last, so searches run at 0
+    # and megadocs at 9 wherever they do share a worker.
+    task_default_priority=5,
+    broker_transport_options={
+        'priority_steps': list(range(10)),
+        'queue_order_strategy': 'priority',
+        # Megadoc builds are only acknowledged once they finish, and Redis
+        # hands an unacknowledged task to another worker after this many
+        # seconds, so it has to be longer than the longest build.
+        'visibility_timeout': int(os.getenv('ORCA_VISIBILITY_TIMEOUT', 12 * 3600)),
+    },
+    # Don't let a worker hold on to tasks it hasn't started yet.
+    worker_prefetch_multiplier=1,
+)
 batch_path = Path(os.getenv('ORCA_CURRENT_BATCH_PATH', 'data/00_initial'))
+# Other batches to search along with the current one, separated by os.pathsep.
+federated_paths = [
+    Path(p) for p in os.getenv('ORCA_FEDERATED_BATCH_PATHS', '').split(os.pathsep) if p
+]
+megadoc_filetypes = ['txt', 'docx']
 
-with (batch_path / 'cache' / 'index.json').open() as f:
-    doc_count = len(json.load(f)['images'])
 
+def batch_doc_count(batch_path):
+    """Return the number of documents in a batch's current image index."""
+    from orca.binindex import current_index_file, read_header
 
-@celery.task(bind=True)
-def do_search(self, query_str):
-    """TODO: Description."""
+    index_file = current_index_file(Path(batch_path) / 'cache')
+    if index_file.suffix == '.bin':
+        return read_header(index_file)['doc_count']
+    with index_file.open() as f:
+        return len(json.load(f)['images'])
+
+
+doc_count = batch_doc_count(batch_path)
+
+
+def claim_search(key, owner):
+    """
+    Claim a search for one task, so identical queries submitted while it runs
+    join it instead of starting their own. Uses Redis (SET NX) when
+    ORCA_CLAIM_URL is set, or the batch's registry otherwise. Returns the ID
+    of the task that holds the claim.
+    """
+    from orca.registry import claim
+
+    ttl = float(os.getenv('ORCA_CLAIM_TTL', 3600))
+    if os.getenv('ORCA_CLAIM_URL'):
+        import redis
+
+        client = redis.Redis.from_url(os.getenv('ORCA_CLAIM_URL'))
+        redis_key = f"orca:claim:{batch_path.resolve()}:{key}"
+        if client.set(redis_key, owner, nx=True, ex=int(ttl)):
+            return owner
+        holder = client.get(redis_key)
+        if holder is None:
+            return claim_search(key, owner)  # Released in between; try again.
+        return holder.decode('utf-8')
+    return claim(batch_path, key, owner, ttl)
+
+
+def renew_search(key, owner):
+    """
+    Extend a claim taken by `claim_search` for another ORCA_CLAIM_TTL seconds,
+    if `owner` still holds it, so it doesn't run out while megadocs are built.
+    """
+    from orca.registry import renew_claim
+
+    ttl = float(os.getenv('ORCA_CLAIM_TTL', 3600))
+    if os.getenv('ORCA_CLAIM_URL'):
+        import redis
+
+        client = redis.Redis.from_url(os.getenv('ORCA_CLAIM_URL'))
+        renew = client.register_script(
+            "if redis.call('get', KEYS[1]) == ARGV[1] then "
+            "return redis.call('expire', KEYS[1], ARGV[2]) else return 0 end"
+        )
+        return bool(
+            renew(keys=[f"orca:claim:{batch_path.resolve()}:{key}"], args=[owner, int(ttl)])
+        )
+    return renew_claim(batch_path, key, owner, ttl)
+
+
+def release_search(key, owner):
+    """Release a claim taken by `claim_search`, if `owner` still holds it."""
+    from orca.registry import release_claim
+
+    if os.getenv('ORCA_CLAIM_URL'):
+        import redis
+
+        client = redis.Redis.from_url(os.getenv('ORCA_CLAIM_URL'))
+        release = client.register_script(
+            "if redis.call('get', KEYS[1]) == ARGV[1] then "
+            "return redis.call('del', KEYS[1]) else return 0 end"
+        )
+        release(keys=[f"orca:claim:{batch_path.resolve()}:{key}"], args=[owner])
+    else:
+        release_claim(batch_path, key, owner)
+
+
+def submit_search(query_str, filters=None):
+    """
+    Start a search (and its megadocs), restricted by album and date `filters`
+    if given, without waiting for it. Returns the ID
+    of the task doing the work, whether it was already running, and the ID
+    of the search if it has already been done in full.
+    """
+    from orca.search import find_search
+
+    search_info, cache_key, generation = find_search(query_str, batch_path, filters)
+    if (
+        search_info
+        and search_info['results']['complete']
+        and search_info['megadocs']
+        and all(d['complete'] for d in search_info['megadocs'])
+    ):
+        return {'task_id': None, 'coalesced': False, 'search_id': search_info['uuid']}
+
+    key = f"{generation}:{cache_key}"
+    task_id = f"{uuid4()}"
+    owner = claim_search(key, task_id)
+    if owner == task_id:
+        try:
+            do_search.apply_async(
+                (query_str,),
+                {'claim_key': key, 'filters': filters},
+                task_id=task_id,
+            )
+        except BaseException:
+            release_search(key, task_id)
+            raise
+    return {
+        'task_id': owner,
+        'coalesced': owner != task_id,
+        'search_id': search_info['uuid'] if search_info else None,
+    }
+
+
+@celery.task(bind=True, priority=0)
+def do_search(self, query_str, claim_key=None, filters=None):
+    """
+    Run a search, then hand its megadocs out to `build_megadoc` tasks: one
+    per filetype, or one per volume when ORCA_MEGADOC_VOLUME_SIZE is set. The
+    claim on the query is released once they have all finished.
+    """
+    from math import ceil
+    from celery import chord
+    from orca.metrics import flush, span
     from orca.search import search
-    from orca.megadoc import build_from_search
 
+    volume_size = int(os.getenv('ORCA_MEGADOC_VOLUME_SIZE', 0)) or None
     print(f"Searching: {query_str}")
-    search(query_str, batch_path)
-    build_from_search(query_str, batch_path)
+    try:
+        self.update_state(state='PROGRESS', meta={'stage': 'search'})
+        with span('do_search'):
+            results, search_info = search(query_str, batch_path, filters=filters)
+
+        owner = self.request.id
+        claim = {'claim_key': claim_key, 'owner': owner}
+        if volume_size:
+            builds = [
+                build_megadoc.si(
+                    query_str, megadoc_filetypes, volume_size, [i + 1], filters, **claim
+                )
+                for i in range(ceil(len(results) / volume_size))
+            ]
+        else:
+            builds = [
+                build_megadoc.si(query_str, [f], filters=filters, **claim)
+                for f in megadoc_filetypes
+            ]
+        finish = finish_search.si(query_str, claim_key, owner, volume_size, filters)
+        finish.link_error(finish_search.si(query_str, claim_key, owner))
+        if builds:
+            chord(builds)(finish)
+        else:
+            finish.delay()
+    except BaseException:
+        if claim_key:
+            release_search(claim_key, self.request.id)
+        raise
+    finally:
+        flush()
     print(f"Search complete: {query_str}")
+    return {'search_id': search_info['uuid'], 'megadoc_tasks': len(builds)}
+
+
+@celery.task(
+    bind=True,
+    priority=9,
+    acks_late=True,
+    reject_on_worker_lost=True,
+    autoretry_for=(Exception,),
+    max_retries=3,
+    retry_backoff=True,
+)
+def build_megadoc(
+    self,
+    query_str,
+    filetypes,
+    volume_size=None,
+    volumes=None,
+    filters=None,
+    claim_key=None,
+    owner=None,
+):
+    """
+    Build the megadoc of each of `filetypes` for a search, or only the given
+    volumes of them. The task is acknowledged once it's done, so if its worker
+    dies it runs again, and picks up from the volumes and rendered pages that
+    were already written. While it runs, it keeps renewing `owner`'s claim on
+    the query.
+    """
+    from time import time
+    from orca.megadoc import build_from_search
+    from orca.metrics import flush
+
+    renew_secs = float(os.getenv('ORCA_CLAIM_TTL', 3600)) / 4
+    last_update = 0
+    last_renewal = time()
+    if claim_key:
+        renew_search(claim_key, owner)
+
+    def progress(filetype, pages):
+        nonlocal last_update, last_renewal
+        if time() - last_update > 1:
+            meta = {'stage': 'megadoc', 'filetype': filetype, 'pages': pages}
+            if volumes:
+                meta['volumes'] = volumes
+            self.update_state(state='PROGRESS', meta=meta)
+            last_update = time()
+        if claim_key and time() - last_renewal > renew_secs:
+            renew_search(claim_key, owner)
+            last_renewal = time()
+
+    try:
+        build_from_search(
+            query_str,
+            batch_path,
+            filetypes,
+            volume_size=volume_size,
+            workers=1,
+            volumes=volumes,
+            progress=progress,
+            filters=filters,
+        )
+    finally:
+        flush()
+
+
+@celery.task(priority=0)
+def finish_search(query_str, claim_key, owner, volume_size=None, filters=None):
+    """
+    Record the final state of a search's megadocs once every build task has
+    finished (or one has failed), and release the claim on the query.
+    """
+    from orca.megadoc import build_from_search
+
+    try:
+        if volume_size:
+            # Volumes finish in any order on different workers.
+            build_from_search(
+                query_str,
+                batch_path,
+                megadoc_filetypes,
+                volume_size,
+                volumes=[],
+                filters=filters,
+            )
+    finally:
+        if claim_key:
+            release_search(claim_key, owner)
 
 
 @app.route('/orca/api/index')
 def api_get_index():
-    """TODO: Description."""
+    """
+    Return the search index. Responses carry an ETag, so clients that send
+    If-None-Match get a 304 after a single lookup of the registry revision.
+    """
+    from orca.registry import list_searches, revision
+
+    version = f"{revision(batch_path)}"
+    if request.if_none_match.contains(version):
+        return Response(status=304, headers={'ETag': f'"{version}"'})
+
+    rev, search_index, _ = list_searches(batch_path)
+    response = jsonify(search_index)
+    response.set_etag(f"{rev}")
+    return response
+
+
+@app.route('/orca/api/index/stream')
+def api_stream_index():
+    """
+    Push changes to the search index as Server-Sent Events. Each event holds
+    only the searches that were added or changed since the last one, plus the
+    UUIDs of any that were removed. Searches are only read from the registry
+    when its revision has moved on.
+    """
     import time
-    from orca.search import load_search_cache
+    from orca.registry import list_searches, revision
+
+    def events():
+        rev = 0
+        last_event = 0
+        while True:
+            if revision(batch_path) != rev or not last_event:
+                rev, changed, removed = list_searches(batch_path, since=rev)
+                data = json.dumps({'changed': changed, 'removed': removed})
+                yield f"id: {rev}\ndata: {data}\n\n"
+                last_event = time.time()
+
+            # Keep the connection alive through proxies while nothing changes.
+            if time.time() - last_event > 15:
+                yield ': keepalive\n\n'
+                last_event = time.time()
+            time.sleep(0.5)
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@app.route('/orca/api/cache')
+def api_get_cache():
+    """Return the search cache's hit, miss, eviction and invalidation counts."""
+    from orca.registry import get_stats
+
+    stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+    stats.update(get_stats(batch_path))
+    return jsonify(stats)
+
+
+@app.route('/orca/api/megadocs/<search_uuid>/<filetype>.zip')
+def api_get_megadoc_zip(search_uuid, filetype):
+    """Stream every volume of a megadoc as one zip file."""
+    from orca.megadoc import stream_zip
+    from orca.registry import get_search_by_uuid
+
+    search_info = get_search_by_uuid(batch_path, search_uuid)
+    megadoc_info = next(
+        (
+            d
+            for d in (search_info or {}).get('megadocs', [])
+            if d['filetype'] == filetype and 'volumes' in d
+        ),
+        None,
+    )
+    if not megadoc_info:
+        return jsonify({'error': 'Megadoc not found.'}), 404
+    if not megadoc_info['complete']:
+        return jsonify({'error': 'Megadoc is still being built.'}), 409
+
+    stem = Path(search_info['results']['json_path']).stem
+    return Response(
+        stream_with_context(stream_zip(v['path'] for v in megadoc_info['volumes'])),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': f'attachment; filename="{stem}_{filetype}.zip"'
+        },
+    )
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Return timings and counters from the web app and the Celery workers in
+    the Prometheus text format (empty unless ORCA_METRICS_DIR is set).
+    """
+    from orca.metrics import render
+
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
 
-    retries = 3
-    while retries > 0:
-        search_index, _ = load_search_cache(batch_path)
-        if search_index:
-            break
-        time.sleep(0.1)
-        retries -= 1
-    return jsonify(search_index)
+def request_filters(values):
+    """
+    Return the album and date filters from a request's parameters (or JSON
+    body): any number of `album`s, `start` and `end` dates, and whether the
+    search is `tolerant` of misspellings. Raises ValueError for dates that
+    aren't ISO 8601.
+    """
+    from orca.search import normalize_filters
+
+    if hasattr(values, 'getlist'):
+        albums = values.getlist('album')
+    else:
+        albums = values.get('album') or []
+    tolerant = values.get('tolerant') in (True, '1', 'true', 'on')
+    return normalize_filters(albums, values.get('start'), values.get('end'), tolerant)
+
+
+def request_page(values):
+    """
+    Return the query, page and filters of a search request from its
+    parameters: `q`, `offset` (default 0), `limit` (default 20, at most 100)
+    and the filters taken by `request_filters`. Raises ValueError, with a
+    message for the client, for anything missing or malformed.
+    """
+    query_str = values.get('q', '').strip()
+    if not query_str:
+        raise ValueError('Missing query (q).')
+    try:
+        offset = max(0, int(values.get('offset', 0)))
+        limit = min(100, max(1, int(values.get('limit', 20))))
+    except ValueError:
+        raise ValueError('offset and limit must be integers.')
+    try:
+        filters = request_filters(values)
+    except ValueError as e:
+        raise ValueError(f"Bad date filter: {e}")
+    return query_str, offset, limit, filters
+
+
+@app.route('/orca/api/search')
+def api_search():
+    """
+    Return one page of ranked results for `q`, starting at `offset` (default
+    0) with up to `limit` (default 20, at most 100) hits, optionally only
+    from the given `album`s and between `start` and `end` dates. With
+    `tolerant`, query terms also match misspellings of them.
+    """
+    from orca.search import search_page
+
+    try:
+        query_str, offset, limit, filters = request_page(request.args)
+    except ValueError as e:
+        return jsonify({'error': f"{e}"}), 400
+
+    return jsonify(search_page(query_str, batch_path, offset, limit, filters))
+
+
+@app.route('/orca/api/federated')
+def api_federated_search():
+    """
+    Search the current batch and every batch in ORCA_FEDERATED_BATCH_PATHS at
+    once and return one page of the merged results, from `offset` with up to
+    `limit` hits, ordered by `sort` (`score` or `timestamp`), with the count
+    and time for each batch. Takes the same filters as /orca/api/search.
+    """
+    from orca.search import SORT_KEYS, federated_page
+
+    try:
+        query_str, offset, limit, filters = request_page(request.args)
+    except ValueError as e:
+        return jsonify({'error': f"{e}"}), 400
+    sort = request.args.get('sort', 'score')
+    if sort not in SORT_KEYS:
+        return jsonify({'error': f"sort must be one of: {', '.join(SORT_KEYS)}."}), 400
+
+    return jsonify(
+        federated_page(
+            query_str, [batch_path, *federated_paths], offset, limit, filters, sort
+        )
+    )
+
+
+@app.route('/orca/api/searches', methods=['POST'])
+def api_submit_search():
+    """
+    Start a search for `q` and return straight away (202) with the ID of the
+    task running it. Identical queries already in progress share one task.
+    Takes the same filters as /orca/api/search.
+    """
+    body = request.get_json(silent=True) or request.form
+    query_str = (body.get('q') or '').strip()
+    if not query_str:
+        return jsonify({'error': 'Missing query (q).'}), 400
+    try:
+        filters = request_filters(body)
+    except ValueError as e:
+        return jsonify({'error': f"Bad date filter: {e}"}), 400
+    return jsonify(
+        {'query_str': query_str, 'filters': filters, **submit_search(query_str, filters)}
+    ), 202
+
+
+@app.route('/orca/api/tasks/<task_id>')
+def api_get_task(task_id):
+    """Return the state of a search or megadoc task, with its progress."""
+    result = celery.AsyncResult(task_id)
+    info = result.info
+    if isinstance(info, BaseException):
+        info = {'error': repr(info)}
+    return jsonify({'task_id': task_id, 'state': result.state, 'info': info})
 
 
 @app.route('/orca/search', methods=['GET', 'POST'])
 def search():
     """TODO: Description."""
-    import time
-
     if request.method == 'POST':
-        query_str = request.form['query']
-        do_search.delay(query_str)
-        time.sleep(2)
+        try:
+            filters = request_filters(request.form)
+        except ValueError as e:
+            return render_template(
+                'search.html', total=doc_count, error=f"Bad date filter: {e}"
+            ), 400
+        submit_search(request.form['query'], filters)
         return redirect(url_for('search'))
 
     return render_template('search.html', total=doc_count)